@@ -1,7 +1,11 @@
 # Reference table data on Mass Attenuation for various materials
 # To be used with Internal Calibration.
+#
+# The tables are kept in a registry of contiguous float64 arrays keyed by
+# material name. Use get(material) for the (energy, mass attenuation) arrays.
+# The Pandas tables (e.g. air_table) are only built when first accessed.
 
-import pandas as pd
+from collections import OrderedDict
 import numpy as np
 
 adipose_data = np.array([[
@@ -876,21 +880,53 @@ water_data = np.array([[
 water_data[0,:] = water_data[0,:] * 1000
 
 ##
-# Define the Pandas Tables for each material
-adipose_table = pd.DataFrame({'Energy [keV]':adipose_data[0,:], 'Mass Attenuation [cm2/g]':adipose_data[1,:]})
+# Registry of the reference materials
+_registry = OrderedDict()
+_tables = {}
 
-air_table = pd.DataFrame({'Energy [keV]':air_data[0,:], 'Mass Attenuation [cm2/g]':air_data[1,:]})
+def register(material, data):
+    """Adds a material to the registry.
+    The first argument is the material name.
+    The second argument is the 2xN array of energy [keV] and mass attenuation [cm2/g].
+    """
+    energy = np.ascontiguousarray(data[0], dtype=np.float64)
+    attenuation = np.ascontiguousarray(data[1], dtype=np.float64)
+    energy.flags.writeable = False
+    attenuation.flags.writeable = False
+    _registry[material] = (energy, attenuation)
+    _tables.pop(material, None)
 
-blood_table = pd.DataFrame({'Energy [keV]':blood_data[0,:], 'Mass Attenuation [cm2/g]':blood_data[1,:]})
+def get(material):
+    """Returns the (energy [keV], mass attenuation [cm2/g]) arrays of the material."""
+    try:
+        return _registry[material]
+    except KeyError:
+        raise KeyError("Unknown material '%s', available materials: %s" % (material, ', '.join(_registry)))
 
-bone_table = pd.DataFrame({'Energy [keV]':bone_data[0,:], 'Mass Attenuation [cm2/g]':bone_data[1,:]})
+def materials():
+    """Returns the names of the registered materials."""
+    return list(_registry)
 
-muscle_table = pd.DataFrame({'Energy [keV]':muscle_data[0,:], 'Mass Attenuation [cm2/g]':muscle_data[1,:]})
+def table(material):
+    """Returns the Pandas table of the material, built on first use."""
+    if material not in _tables:
+        import pandas as pd
+        energy, attenuation = get(material)
+        _tables[material] = pd.DataFrame({'Energy [keV]':energy, 'Mass Attenuation [cm2/g]':attenuation})
+    return _tables[material]
 
-k2hpo4_table = pd.DataFrame({'Energy [keV]':k2hpo4_data[0,:], 'Mass Attenuation [cm2/g]':k2hpo4_data[1,:]})
+def __getattr__(name):
+    # Provides the <material>_table names on demand
+    if name.endswith('_table') and name[:-len('_table')] in _registry:
+        return table(name[:-len('_table')])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-cha_table = pd.DataFrame({'Energy [keV]':cha_data[0,:], 'Mass Attenuation [cm2/g]':cha_data[1,:]})
-
-triglyceride_table = pd.DataFrame({'Energy [keV]':triglyceride_data[0,:], 'Mass Attenuation [cm2/g]':triglyceride_data[1,:]})
-
-water_table = pd.DataFrame({'Energy [keV]':water_data[0,:], 'Mass Attenuation [cm2/g]':water_data[1,:]})
+register('adipose', adipose_data)
+register('air', air_data)
+register('blood', blood_data)
+register('bone', bone_data)
+register('muscle', muscle_data)
+register('k2hpo4', k2hpo4_data)
+register('cha', cha_data)
+register('triglyceride', triglyceride_data)
+register('water', water_data)
@@ -0,0 +1,140 @@
+#####
+# benchmark_imports.py
+#
+# Times the start up (module import) of the calibration modules and records
+# which toolkits each one loads, and writes a JSON report.
+#
+# Every measurement runs in a fresh Python process, so nothing is already
+# imported. Besides the plain imports, a headless calibration of a small
+# synthetic phantom is run, which must not load Qt at all. The script exits
+# with an error if Qt is loaded by the helper module, the batch script or the
+# headless calibration.
+#
+# usage: python benchmarks/benchmark_imports.py
+#        python benchmarks/benchmark_imports.py --repeat 5 --output imports.json
+#####
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+from benchmark_pipeline import gitCommit
+
+# Toolkits whose load is reported (a module counts if it or a submodule is loaded)
+toolkits = ['PyQt5', 'SimpleITK', 'pandas', 'scipy.stats', 'scipy.interpolate', 'vtk', 'vtkbone']
+
+# Targets that must start without Qt
+headless = ['ogo_helper_3Materials_BoneMuscleAir', 'ogo_IC_3Materials_batch', 'headless calibration']
+
+modules = [
+    'vtk_numpy_views',
+    'nifti_mmap',
+    'label_statistics',
+    'viewer_session',
+    'ogo_helper_3Materials_BoneMuscleAir',
+    'ogo_IC_3Materials_batch',
+    'gui'
+]
+
+# Run in the child process: times the import (plus the calibration, for the
+# headless calibration) and prints the result as JSON on the last line of its output
+child_code = '''
+import sys, json, time
+sys.path.insert(0, %(repository)r)
+sys.path.insert(0, %(benchmarks)r)
+start = time.perf_counter()
+import %(module)s
+seconds = time.perf_counter() - start
+if %(directory)r:
+    from benchmark_pipeline import makePhantom
+    image, mask = makePhantom((64, 64, 32), %(directory)r)
+    start = time.perf_counter() - seconds
+    %(module)s.icCalibrateStudy(image, mask, %(directory)r)
+    seconds = time.perf_counter() - start
+toolkits = %(toolkits)r
+loaded = [t for t in toolkits if any(m == t or m.startswith(t + '.') for m in sys.modules)]
+print(json.dumps({'seconds': seconds, 'modules': len(sys.modules), 'toolkits': loaded}))
+'''
+
+
+def runChild(module, directory=''):
+    """Imports a module (and runs a headless calibration if a directory is
+    given) in a fresh Python process.
+    Returns the import time in seconds, the number of loaded modules and the
+    list of loaded toolkits as a dictionary.
+    """
+    code = child_code % {
+        'repository': repository,
+        'benchmarks': os.path.dirname(os.path.abspath(__file__)),
+        'module': module,
+        'directory': directory,
+        'toolkits': toolkits
+        }
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=directory or repository)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def benchmarkTarget(name, repeat, directory=''):
+    """Runs a target repeat times and keeps the fastest run."""
+    module = 'ogo_helper_3Materials_BoneMuscleAir' if directory else name
+    runs = [runChild(module, directory) for i in range(repeat)]
+    best = min(runs, key=lambda run: run['seconds'])
+    return OrderedDict([
+        ('seconds', best['seconds']),
+        ('all seconds', [run['seconds'] for run in runs]),
+        ('modules', best['modules']),
+        ('toolkits', best['toolkits'])
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the calibration modules.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of fresh processes per target, the fastest is kept (default: 3)')
+    parser.add_argument('--output', default='bench_imports.json',
+                        help='JSON report file (default: bench_imports.json)')
+    args = parser.parse_args()
+
+    report = OrderedDict([
+        ('commit', gitCommit()),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('results', OrderedDict())
+        ])
+
+    for module in modules:
+        report['results'][module] = benchmarkTarget(module, args.repeat)
+
+    directory = tempfile.mkdtemp(prefix='ogo_bench_')
+    try:
+        report['results']['headless calibration'] = benchmarkTarget('headless calibration', 1, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print('%-38s %8s %8s  %s' % ('target', 'seconds', 'modules', 'toolkits'))
+    for name, result in report['results'].items():
+        print('%-38s %8.3f %8d  %s' % (name, result['seconds'], result['modules'], ', '.join(result['toolkits'])))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Wrote %s' % args.output)
+
+    with_qt = [name for name in headless if 'PyQt5' in report['results'][name]['toolkits']]
+    if with_qt:
+        print('ERROR: Qt is loaded by %s' % ', '.join(with_qt))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#####
+# benchmark_pipeline.py
+#
+# Times the stages of the internal calibration pipeline on synthetic CT phantoms
+# and writes a JSON report, so that performance of the helper module can be
+# tracked and compared between commits.
+#
+# Each phantom is an int16 CT volume with air (-1000 HU), a soft tissue body
+# (40 HU), skeletal muscle (50 HU) and a cortical bone rod (1200 HU), plus the
+# matching ITK-SNAP label map (Air = 2, Cortical Bone = 4, Skeletal Muscle = 5).
+# Every size runs in a fresh process so that the peak RSS is per phantom. Each
+# stage records the peak RSS after it and how much the stage raised it.
+#
+# usage: python benchmarks/benchmark_pipeline.py
+#        python benchmarks/benchmark_pipeline.py --sizes 256x256x256 --output bench.json
+#        python benchmarks/benchmark_pipeline.py --compare old.json
+#####
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import concurrent.futures
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+default_sizes = '256x256x256,512x512x500,512x512x1500'
+phantom_HU = OrderedDict([('Air', -1000), ('Cortical Bone', 1200), ('Skeletal Muscle', 50)])
+phantom_labels = OrderedDict([('Air', 2), ('Cortical Bone', 4), ('Skeletal Muscle', 5)])
+
+
+def peakRSS():
+    """Returns the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def makePhantom(dimensions, directory, noise=20, seed=0):
+    """Writes a synthetic CT phantom and its label map as NIFTI files.
+    The first argument is the (x, y, z) dimensions.
+    The second argument is the output directory.
+    Returns the image and mask file names.
+    """
+    import vtk
+    from vtk_numpy_views import numpyToImage
+
+    nx, ny, nz = dimensions
+    image = np.empty((nz, ny, nx), dtype=np.int16)
+    mask = np.zeros((nz, ny, nx), dtype=np.uint8)
+
+    y, x = np.ogrid[0:ny, 0:nx]
+    r = np.hypot((x - nx/2) / (0.45*nx), (y - ny/2) / (0.35*ny))
+    body = r < 1
+    bone = np.hypot(x - nx/2, y - 0.6*ny) < 0.06*min(nx, ny)
+    muscle = (np.abs(x - 0.3*nx) < 0.08*nx) & (np.abs(y - ny/2) < 0.08*ny)
+    air = (x < 0.08*nx) & (y < 0.08*ny)
+
+    background = np.full((ny, nx), phantom_HU['Air'], dtype=np.int16)
+    background[body] = 40
+    background[muscle] = phantom_HU['Skeletal Muscle']
+    background[bone] = phantom_HU['Cortical Bone']
+    labels = np.zeros((ny, nx), dtype=np.uint8)
+    labels[air] = phantom_labels['Air']
+    labels[muscle] = phantom_labels['Skeletal Muscle']
+    labels[bone] = phantom_labels['Cortical Bone']
+
+    ##
+    # Fill slice by slice so that the noise does not need a full size float temporary
+    rng = np.random.default_rng(seed)
+    for k in range(nz):
+        image[k] = background + rng.normal(0, noise, (ny, nx)).astype(np.int16)
+        if nz//4 <= k < 3*nz//4:
+            mask[k] = labels
+
+    names = []
+    for name, array in (('image', image), ('mask', mask)):
+        # the transpose of the [z, y, x] array is indexed [x, y, z] and shares its memory
+        vtk_image = numpyToImage(array.T, spacing=(0.7, 0.7, 1.0))
+        fileName = os.path.join(directory, 'phantom_%dx%dx%d_%s.nii' % (nx, ny, nz, name))
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(vtk_image)
+        writer.SetFileName(fileName)
+        writer.Write()
+        names.append(fileName)
+
+    return names
+
+
+def benchmarkSize(dimensions, directory):
+    """Runs and times every pipeline stage on one phantom size.
+    Returns a dictionary with the results of each stage.
+    """
+    import ogo_helper_3Materials_BoneMuscleAir as ogo
+
+    image, mask = makePhantom(dimensions, directory)
+    voxels = int(np.prod(dimensions))
+    stages = OrderedDict()
+    values = {}
+
+    def stage(name, function, *args):
+        # The peak RSS is the high-water mark of the process, so its increase
+        # during a stage is the memory that stage needed beyond earlier stages
+        rss = peakRSS()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = function(*args)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stages[name] = OrderedDict([
+            ('seconds', wall),
+            ('cpu seconds', cpu),
+            ('voxels per second', voxels / wall if wall > 0 else float('inf')),
+            ('peak RSS [MB]', peakRSS()),
+            ('peak RSS increase [MB]', peakRSS() - rss)
+            ])
+        return result
+
+    def calibrationParameters(ic_parameters, mean_hu):
+        attenuation = [ic_parameters['Air u/p'], ic_parameters['Cortical Bone u/p'], ic_parameters['Skeletal Muscle u/p']]
+        densities = [ogo.icMaterialDensity(hu, u, ic_parameters['Water u/p'], 1.0) for hu, u in zip(mean_hu, attenuation)]
+        cali_parameters = OrderedDict(ic_parameters)
+        cali_parameters.update(ogo.icLinearRegression(mean_hu, attenuation, 'HU-u/p Slope', 'HU-u/p Y-Intercept'))
+        cali_parameters.update(ogo.icLinearRegression(mean_hu, densities, 'HU-Material Density Slope', 'HU-Material Density Y-Intercept'))
+        return cali_parameters
+
+    baseline_rss = peakRSS()
+    imageData = stage('read', lambda: (ogo.readNii(image), ogo.readNii(mask)))
+    imageData, maskData = imageData
+    stage('read (mmap)', lambda: (ogo.readNii(image, mmap=True), ogo.readNii(mask, mmap=True)))
+    roi_stats = stage('ROI stats', ogo.labelStatistics, imageData, maskData, list(phantom_labels.values()))
+    mean_hu = [roi_stats[label]['mean'] for label in phantom_labels.values()]
+    grid = ogo.icAttenuationGrid()
+    ic_parameters = stage('icEffectiveEnergyGrid', ogo.icEffectiveEnergyGrid, mean_hu, grid)
+    # includes the first use (import) of scipy.stats for the regressions
+    cali_parameters = stage('regression and densities', calibrationParameters, ic_parameters, mean_hu)
+    calibrated_image, ARCH_image = stage('applyInternalCalibration', ogo.applyInternalCalibration, imageData, cali_parameters)
+    stage('writeNii', ogo.writeNii, calibrated_image, 'phantom_IC_K2HPO4.nii', directory, ogo.coronalQFormMatrix())
+
+    return OrderedDict([
+        ('dimensions', list(dimensions)),
+        ('voxels', voxels),
+        ('baseline peak RSS [MB]', baseline_rss),
+        ('ROI mean HU', OrderedDict(zip(phantom_labels, mean_hu))),
+        ('Effective Energy [keV]', float(ic_parameters['Effective Energy [keV]'])),
+        ('stages', stages)
+        ])
+
+
+def gitCommit():
+    """Returns the current git commit of the repository, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareReports(old, new):
+    """Prints the wall time ratio and the peak RSS increase of every stage
+    between two reports."""
+    old_results = {tuple(r['dimensions']): r for r in old['results']}
+    print('%-16s %-26s %10s %10s %8s %12s %12s' % ('size', 'stage', 'old [s]', 'new [s]', 'speedup', 'old +MB', 'new +MB'))
+    for result in new['results']:
+        dimensions = tuple(result['dimensions'])
+        if dimensions not in old_results:
+            continue
+        size = 'x'.join(str(d) for d in dimensions)
+        for name, stage in result['stages'].items():
+            old_stage = old_results[dimensions]['stages'].get(name)
+            if old_stage is None:
+                continue
+            print('%-16s %-26s %10.3f %10.3f %7.2fx %12.0f %12.0f' % (
+                size, name, old_stage['seconds'], stage['seconds'],
+                old_stage['seconds'] / stage['seconds'] if stage['seconds'] > 0 else float('inf'),
+                old_stage.get('peak RSS increase [MB]', float('nan')), stage['peak RSS increase [MB]']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the internal calibration pipeline on synthetic phantoms.')
+    parser.add_argument('--sizes', default=default_sizes,
+                        help='comma separated list of XxYxZ phantom sizes (default: %s)' % default_sizes)
+    parser.add_argument('--output', default='bench_output.json',
+                        help='JSON report file (default: bench_output.json)')
+    parser.add_argument('--compare', default=None,
+                        help='earlier JSON report to compare against')
+    parser.add_argument('--workdir', default=None,
+                        help='directory for the phantom files (default: a temporary directory)')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(n) for n in size.lower().split('x')) for size in args.sizes.split(',')]
+
+    report = OrderedDict([
+        ('commit', gitCommit()),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('results', [])
+        ])
+
+    for dimensions in sizes:
+        print('Benchmarking %s phantom...' % 'x'.join(str(d) for d in dimensions))
+        directory = tempfile.mkdtemp(prefix='ogo_bench_', dir=args.workdir)
+        try:
+            # A fresh process per size keeps the peak RSS of each phantom separate
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(benchmarkSize, dimensions, directory).result()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        report['results'].append(result)
+        for name, stage in result['stages'].items():
+            print('  %-26s %8.3f s %12.3g voxels/s %8.0f MB peak %+8.0f MB' % (
+                name, stage['seconds'], stage['voxels per second'], stage['peak RSS [MB]'], stage['peak RSS increase [MB]']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Wrote %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compareReports(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
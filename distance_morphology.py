@@ -0,0 +1,129 @@
+#####
+# distance_morphology.py
+#
+# Erosion and dilation of label images by thresholding Euclidean distance
+# transforms, with the same results as vtkImageContinuousErode3D and
+# vtkImageContinuousDilate3D.
+#
+# The VTK filters take the minimum (maximum) over an ellipsoid that fills the
+# kernel box, visiting every kernel voxel for every image voxel, so their cost
+# grows with the kernel volume. Here a voxel is dilated when the scaled
+# distance to the nearest foreground voxel is at most one, which takes one
+# distance transform whatever the kernel size.
+#
+# VTK kernel semantics, matched exactly:
+# - the kernel of size k along an axis is the ellipsoid with radius k/2 centred
+#   at (k-1)/2 in a box of k voxels, and the middle (output) voxel is k//2, so
+#   an even kernel reaches one voxel further in the negative direction;
+# - voxels outside the image are ignored (the border does not erode);
+# - grey values are handled by threshold decomposition, so the output is the
+#   minimum (maximum) of the input over the kernel as in VTK.
+#####
+
+import numpy as np
+from scipy import ndimage
+
+from vtk_numpy_views import imageView, numpyToImage
+
+# Tolerance on the scaled distance, so that kernel voxels lying exactly on the
+# ellipsoid are not lost to rounding
+distance_tolerance = 1e-9
+
+
+def dilate(array, kernel_size):
+    """Dilates (maximum over an ellipsoid kernel) an array indexed [x, y, z].
+    The first argument is the array.
+    The second argument is the (x, y, z) kernel size in voxels.
+    Returns the dilated array.
+    """
+    return _greyMorphology(array, kernel_size, dilate=True)
+
+def dilateImage(imageData, kernel_size):
+    """Dilates a vtkImageData as vtkImageContinuousDilate3D.
+    The first argument is the image.
+    The second argument is the (x, y, z) kernel size in voxels.
+    Returns the dilated vtkImageData.
+    """
+    return _morphologyImage(imageData, kernel_size, dilate=True)
+
+def erode(array, kernel_size):
+    """Erodes (minimum over an ellipsoid kernel) an array indexed [x, y, z].
+    The first argument is the array.
+    The second argument is the (x, y, z) kernel size in voxels.
+    Returns the eroded array.
+    """
+    return _greyMorphology(array, kernel_size, dilate=False)
+
+def erodeImage(imageData, kernel_size):
+    """Erodes a vtkImageData as vtkImageContinuousErode3D.
+    The first argument is the image.
+    The second argument is the (x, y, z) kernel size in voxels.
+    Returns the eroded vtkImageData.
+    """
+    return _morphologyImage(imageData, kernel_size, dilate=False)
+
+def kernelReach(foreground, kernel_size):
+    """Finds the voxels whose kernel contains a foreground voxel, i.e. the
+    binary dilation of the foreground.
+    The first argument is the boolean foreground array indexed [x, y, z].
+    The second argument is the (x, y, z) kernel size in voxels.
+    Returns the boolean array of reached voxels.
+    """
+    kernel_size = tuple(int(k) for k in kernel_size)
+    if len(kernel_size) != foreground.ndim or min(kernel_size) < 1:
+        raise ValueError("ERROR: invalid kernel size %s for a %dD image" % (kernel_size, foreground.ndim))
+    if not foreground.any():
+        return np.zeros(foreground.shape, dtype=bool)
+
+    ##
+    # For an even kernel the ellipsoid is centred half a voxel before the output
+    # voxel, so along those axes the distances are evaluated on a grid refined
+    # by two: foreground voxels sit at the odd positions and the output voxels
+    # (shifted by half a voxel) at the even positions.
+    refined = foreground
+    query = []
+    sampling = []
+    for axis, k in enumerate(kernel_size):
+        radius = k / 2.0
+        if k % 2 == 0:
+            shape = list(refined.shape)
+            shape[axis] *= 2
+            grid = np.zeros(shape, dtype=bool)
+            grid[(slice(None),)*axis + (slice(1, None, 2),)] = refined
+            refined = grid
+            query.append(slice(0, None, 2))
+            sampling.append(0.5 / radius)
+        else:
+            query.append(slice(None))
+            sampling.append(1.0 / radius)
+
+    distance = ndimage.distance_transform_edt(~refined, sampling=sampling)
+    return distance[tuple(query)] <= 1.0 + distance_tolerance
+
+def _greyMorphology(array, kernel_size, dilate):
+
+    levels = np.unique(array)
+    if levels.size < 2:
+        return array.copy()
+
+    ##
+    # Flat erosion and dilation commute with thresholding, so every voxel takes
+    # the highest level whose threshold image, eroded or dilated, is set there.
+    # The threshold images are nested, so assigning the levels in increasing
+    # order leaves the highest one. A binary mask takes a single transform.
+    output = np.full(array.shape, levels[0], dtype=array.dtype, order='F')
+    for level in levels[1:]:
+        above = array >= level
+        if dilate:
+            reached = kernelReach(above, kernel_size)
+        else:
+            reached = ~kernelReach(~above, kernel_size)
+        output[reached] = level
+    return output
+
+def _morphologyImage(imageData, kernel_size, dilate):
+
+    if imageData.GetNumberOfScalarComponents() != 1:
+        raise ValueError("ERROR: morphology needs an image with one scalar component")
+    array = _greyMorphology(imageView(imageData), kernel_size, dilate)
+    return numpyToImage(array, imageData.GetSpacing(), imageData.GetOrigin(), imageData.GetExtent())
@@ -1,3 +1,4 @@
+import os
 import sys
 import copy
 import time
@@ -10,12 +11,176 @@ from PyQt5 import Qt
 from PyQt5.QtWidgets import (
     QMainWindow, QMenuBar, QMenu, QAction, QFileDialog, QErrorMessage,
     QFrame, QVBoxLayout, QHBoxLayout, QGridLayout, QScrollArea, QTableWidget,
-    QGroupBox, QWidget, QPushButton, QTableWidgetItem, QCheckBox
+    QGroupBox, QWidget, QPushButton, QTableWidgetItem, QCheckBox, QProgressBar
 )
 
-from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 import ogo_helper_3Materials_BoneMuscleAir as ogo
+from label_statistics import LabelStatistics
+from vtk_numpy_views import flatView
+
+class FileDlg(QWidget):
+
+    def __init__(self):
+        super().__init__()
+        self.title = 'PyQt5 file dialogs - pythonspot.com'
+        self.left = 10
+        self.top = 10
+        self.width = 640
+        self.height = 480
+        self.initUI()
+
+    def initUI(self):
+        self.setWindowTitle(self.title)
+        self.setGeometry(self.left, self.top, self.width, self.height)
+
+        # self.openFileNameDialog()
+        # self.openFileNamesDialog()
+
+        # self.show()
+
+    def openFileNameDialog(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getOpenFileName(self,"QFileDialog.getOpenFileName()", "","All Files (*);;Python Files (*.py)", options=options)
+        if fileName:
+            # print(fileName)
+            return fileName
+
+def read_data(filepath):
+    # read a dicom or nifti file, None if the extension is not supported
+    if filepath.endswith('.nii'):
+        return ogo.readNii(filepath)
+
+    elif filepath.endswith('.dcm'):
+        return ogo.readDCM(filepath)
+
+    return None
+
+def file_signature(filepath):
+    # identifies one saved version of a file
+    st = os.stat(filepath)
+    return (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+class StatsWorker(QtCore.QThread):
+    """Computes the stats of each material in a background thread so the
+    window stays responsive. Results are emitted per material as they are
+    ready, and the computation stops at the next stat once cancelled.
+    """
+
+    progress = QtCore.pyqtSignal(int)
+    material_done = QtCore.pyqtSignal(str, object)
+
+    mask_loaded = QtCore.pyqtSignal(object)
+    calibration_preview = QtCore.pyqtSignal(object)
+
+    def __init__(self, label_stats, image, mask, materials, mask_path=None, calibration=None, parent=None):
+        # label_stats is the LabelStatistics engine kept between reloads, image
+        # is the flat image array and mask the vtkImageData of the mask, which
+        # is reread from mask_path first when given
+        # materials is a dict of material name -> (label ID, dict of stat name -> function)
+        # calibration is the (air, bone, muscle) label IDs and the attenuation
+        # grid used to preview the calibration from the label means
+        super().__init__(parent)
+        self.label_stats = label_stats
+        self.image = image
+        self.mask = mask
+        self.mask_path = mask_path
+        self.materials = materials
+        self.calibration = calibration
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+
+        start_time = time.time()
+
+        if self.mask_path:
+            try:
+                self.mask = read_data(self.mask_path)
+            except Exception as e:
+                print(f'Could not reload mask {self.mask_path}: {e}')
+                return
+            self.mask_loaded.emit(self.mask)
+
+        mask = flatView(self.mask)
+
+        # one label index for all materials, every stat reads from it; the
+        # engine is shared between workers so only one of them may use it at
+        # a time, and an update is never interrupted halfway
+        with self.label_stats.lock:
+
+            if self.cancelled:
+                return
+
+            try:
+                changed = self.label_stats.update(self.image, mask, self.mask.GetDimensions())
+            except ValueError as e:
+                print(e)
+                return
+
+            n_stats = max(1, sum(len(stats) for ID, stats in self.materials.values()))
+            n_done = 0
+
+            for m, (ID, stats) in self.materials.items():
+
+                values = {}
+
+                for s, function in stats.items():
+
+                    if self.cancelled:
+                        return
+
+                    values[s] = self.label_stats.compute(ID, function)
+
+                    n_done += 1
+                    self.progress.emit(int(100*n_done/n_stats))
+
+                self.material_done.emit(m, values)
+
+            if self.calibration is not None:
+                self.preview_calibration()
+
+        print(f'Took {time.time()-start_time:0.2f} to calculate stats ({len(changed)} labels changed)')
+
+    def preview_calibration(self):
+
+        # the running means are always up to date, whichever stats are enabled
+        labels, grid = self.calibration
+        mean_hu = [self.label_stats.compute(ID, 'mean') for ID in labels]
+        if not np.all(np.isfinite(mean_hu)):
+            self.calibration_preview.emit(None)
+            return
+
+        with np.errstate(all='ignore'):
+            self.calibration_preview.emit(ogo.icCalibrationParameters(mean_hu, grid))
+
+class CalibrationWorker(QtCore.QThread):
+    """Runs the internal calibration of a study in a background thread."""
+
+    calibrated = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, image_path, mask_path, settings, image=None, parent=None):
+        # settings are the orientation matrix, script name and script version
+        # passed on to icCalibrateStudy, image is the image already in memory
+        super().__init__(parent)
+        self.image_path = image_path
+        self.image = image
+        self.mask_path = mask_path
+        self.settings = settings
+        self.signature = file_signature(mask_path)
+
+    def run(self):
+
+        try:
+            cali_parameters = ogo.icCalibrateStudy(self.image_path, self.mask_path, None, *self.settings, imageData=self.image)
+        except Exception as e:
+            print(f'Calibration with {self.mask_path} failed: {e}')
+            return
+
+        self.calibrated.emit(self.signature, cali_parameters)
 
 class MainWindow(QMainWindow):
 
@@ -23,6 +188,32 @@ class MainWindow(QMainWindow):
 
         super().__init__(parent)
 
+        self.image = None
+        self.image_array = None
+        self.mask = None
+        self.mask_path = None
+        self.label_stats = None
+        self.attenuation_grid = None
+        self.stats_worker = None
+        self.running_workers = set()
+
+        # the directory of the image is watched for masks saved from ITK-SNAP,
+        # events are collected until the directory has been quiet for a moment
+        # since a save touches the file several times
+        self.image_path = None
+        self.mask_signature = None
+        self.calibration_settings = None
+        self.calibration = None
+        self.calibration_worker = None
+        self.pending_calibration = None
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self._on_study_changed)
+        self.watcher.fileChanged.connect(self._on_study_changed)
+        self.watch_timer = QtCore.QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(1000)
+        self.watch_timer.timeout.connect(self.check_for_new_mask)
+
         self._create_actions()
         self._create_menu_bar()
 
@@ -62,31 +253,37 @@ class MainWindow(QMainWindow):
         }
 
         # then we define all of the stats we want to calculate, and the
-        # functions used to calculate them
+        # functions used to calculate them (a name is a running moment kept
+        # up to date by LabelStatistics from the changed voxels only)
 
         self.stats_dict = {
             'mean': {
-                'function': self.get_mean,
+                'function': 'mean',
                 'value': 0,
                 'enabled': True
             },
             'standard deviation': {
-                'function': self.get_std,
+                'function': 'standard deviation',
                 'value': 0,
                 'enabled': True
             },
             'min': {
-                'function': self.get_min,
+                'function': 'min',
                 'value': 0,
                 'enabled': True
             },
             'max': {
-                'function': self.get_max,
+                'function': 'max',
                 'value': 0,
                 'enabled': True
             },
+            'median': {
+                'function': self.get_median,
+                'value': 0,
+                'enabled': False
+            },
             'slices': {
-                'function': self.get_slices,
+                'function': 'slices',
                 'value': [],
                 'enabled': True
             }
@@ -107,12 +304,14 @@ class MainWindow(QMainWindow):
 
         self.layout.addWidget(self._create_buttons_group_box())
         self.layout.addWidget(self._create_checkboxes_group_box())
+        self.layout.addWidget(self._create_calibration_group_box())
         self.layout.addWidget(self._create_scroll_area())
 
         self.frame.setLayout(self.layout)
         self.setCentralWidget(self.frame)
 
         self.update_material_tables()
+        self.update_calibration_table()
 
     def _create_buttons_group_box(self):
 
@@ -129,9 +328,19 @@ class MainWindow(QMainWindow):
         self.buttons_group_box_layout.addWidget(self.get_mask_button)
 
         self.update_mask_button = QPushButton('Reload mask,\nupdate parameters.')
-        self.update_mask_button.clicked.connect(self.update_mask)
+        self.update_mask_button.clicked.connect(self.reload_mask)
         self.buttons_group_box_layout.addWidget(self.update_mask_button)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.buttons_group_box_layout.addWidget(self.progress_bar)
+
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_stats)
+        self.cancel_button.setEnabled(False)
+        self.buttons_group_box_layout.addWidget(self.cancel_button)
+
         self.buttons_group_box.setLayout(self.buttons_group_box_layout)
 
         return self.buttons_group_box
@@ -153,6 +362,30 @@ class MainWindow(QMainWindow):
 
         return self.checkboxes_group_box
 
+    def _create_calibration_group_box(self):
+
+        # preview of the calibration derived from the current label means, so the
+        # ROIs can be judged before the full calibration is run
+        self.calibration_group_box = QGroupBox('Calibration preview')
+        self.calibration_group_box_layout = QVBoxLayout()
+
+        self.calibration_preview = None
+        self.calibration_preview_keys = [
+            'Effective Energy [keV]',
+            'Max R^2',
+            'HU-u/p Slope',
+            'HU-u/p Y-Intercept',
+            'HU-Material Density Slope',
+            'HU-Material Density Y-Intercept'
+        ]
+        self.calibration_table = QTableWidget()
+        self.calibration_table.setMinimumHeight(35*len(self.calibration_preview_keys))
+        self.calibration_group_box_layout.addWidget(self.calibration_table)
+
+        self.calibration_group_box.setLayout(self.calibration_group_box_layout)
+
+        return self.calibration_group_box
+
     def _create_scroll_area(self):
 
         self.scroll_area = QScrollArea()
@@ -194,71 +427,248 @@ class MainWindow(QMainWindow):
 
         # if the user closed the dialog without choosing a file then we are done here
         if len(filepath)==0:
-            return None
+            return None, None
 
         # check the file extension and create an appropriate reader object
-        if filepath.endswith('.nii'):
-            data = ogo.readNii(filepath)
-
-        elif filepath.endswith('.dcm'):
-            data = ogo.readDCM(filepath)
+        data = read_data(filepath)
 
-        else:
+        if data is None:
             # because of the filter on the file dialog we should never end up
             # here, but if we do then trigger a warning
             msg = QErrorMessage()
             msg.showMessage("You selected a file other than *.nii or *.dcm, which shouldn't even be possible.")
             msg.exec_()
-            data = None
+            filepath = None
 
-        return data
+        return data, filepath
 
     def get_image(self):
 
-        image = self.get_data_from_file('Select image file')
-        self.image = image if image else self.image
+        image, filepath = self.get_data_from_file('Select image file')
+        if image:
+            self.set_image(image, filepath)
+
+    def set_image(self, image, image_path=None):
+
+        self.cancel_stats()
+        self.image = image
+        self.image_array = flatView(image)
+        # a new image invalidates the label index, the next update builds it
+        self.label_stats = LabelStatistics([self.materials_dict[m]['ID'] for m in self.materials_dict.keys()])
+
+        # masks saved next to the image from now on are picked up automatically
+        self.image_path = os.path.abspath(image_path) if image_path else None
+        self.mask_signature = None
+        if self.watcher.files() or self.watcher.directories():
+            self.watcher.removePaths(self.watcher.files() + self.watcher.directories())
+        if self.image_path and self.image_path.endswith('.nii'):
+            mask = ogo.newestNifti(os.path.dirname(self.image_path), [self.image_path])
+            self.mask_signature = file_signature(mask) if mask else None
+            self.watcher.addPath(os.path.dirname(self.image_path))
+
+    def watch_study(self, image_path, orientation_mat=None, script_name=None, script_version=None, image=None):
+        """Loads the image and, every time a mask is saved next to it, updates
+        the stats and calibrates the study in the background.
+        The first argument is the image file (NIFTI).
+        The next three arguments are passed on to icCalibrateStudy.
+        The last argument is the image when it is already in memory.
+        """
+        self.calibration_settings = (orientation_mat, script_name, script_version)
+        self.set_image(image if image is not None else read_data(image_path), image_path)
+
+    def calibration_for(self, mask_path):
+        # the calibration parameters of the mask as it is saved now, None if it
+        # has not been calibrated (or changed since)
+        if self.calibration and self.calibration[0] == file_signature(mask_path):
+            return self.calibration[1]
+        return None
+
+    def _on_study_changed(self, path):
+
+        self.watch_timer.start()
+
+    def check_for_new_mask(self):
+
+        if self.image_path is None:
+            return
+
+        # a file removed or replaced between the directory scan and the stat
+        # or header read skips this check, the next change triggers another
+        try:
+            mask = ogo.newestNifti(os.path.dirname(self.image_path), [self.image_path])
+            if mask is None:
+                return
+            signature = file_signature(mask)
+        except OSError as e:
+            print(f'Ignoring the mask check: {e}')
+            return
+
+        if signature == self.mask_signature:
+            return
+
+        # a mask that does not fit the image (or is still being written) is
+        # skipped, the next save triggers another check
+        try:
+            ogo.validateMask(self.image_path, mask)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f'Ignoring {mask}: {e}')
+            return
+
+        self.mask_signature = signature
+        if mask not in self.watcher.files():
+            self.watcher.addPath(mask)
+
+        ogo.message("New mask saved: %s" % mask)
+        self.mask_path = mask
+        self.update_mask(mask)
+
+        if self.calibration_settings is not None:
+            self.start_calibration(mask)
+
+    def start_calibration(self, mask_path):
+
+        # one calibration at a time, only the newest of the masks saved in
+        # the meantime is calibrated next
+        if self.calibration_worker is not None:
+            self.pending_calibration = mask_path
+            return
+
+        worker = CalibrationWorker(self.image_path, mask_path, self.calibration_settings, self.image, self)
+        worker.calibrated.connect(lambda signature, cali_parameters: self._on_calibrated(signature, cali_parameters))
+        worker.finished.connect(lambda w=worker: self._on_calibration_finished(w))
+
+        self.calibration_worker = worker
+        self.running_workers.add(worker)
+        self.statusBar().showMessage(f'Calibrating with {os.path.basename(mask_path)}...')
+        worker.start()
+
+    def _on_calibrated(self, signature, cali_parameters):
+
+        self.calibration = (signature, cali_parameters)
+        self.statusBar().showMessage(
+            f"Calibrated with {cali_parameters['Mask']}: "
+            f"effective energy {cali_parameters['Effective Energy [keV]']} keV, "
+            f"R^2 {cali_parameters['Max R^2']:0.4f}"
+        )
+
+    def _on_calibration_finished(self, worker):
+
+        self.running_workers.discard(worker)
+        worker.deleteLater()
+        self.calibration_worker = None
+
+        if self.pending_calibration is not None:
+            mask_path, self.pending_calibration = self.pending_calibration, None
+            self.start_calibration(mask_path)
 
     def get_mask(self):
 
-        mask = self.get_data_from_file('Select mask file')
-        self.mask = mask if mask else self.mask
+        mask, filepath = self.get_data_from_file('Select mask file')
+        if mask:
+            self.mask = mask
+            self.mask_path = filepath
 
         self.update_mask()
 
-    def update_mask(self):
+    def reload_mask(self):
+
+        # reread the mask from disk (e.g. after editing it in ITK-SNAP), only
+        # the slices that changed since the last update are recomputed
+        self.update_mask(self.mask_path)
+
+    def _on_mask_loaded(self, worker, mask):
+
+        if worker is self.stats_worker:
+            self.mask = mask
+
+    def update_mask(self, mask_path=None):
 
         if not(self.image):
             print('No image loaded, cannot update')
             return
 
-        if not(self.mask):
+        if not(self.mask) and not(mask_path):
             print('No mask loaded, cannot update')
             return
 
-        start_time = time.time()
+        # a reload while stats are still being calculated makes those stats
+        # stale, so abort that job instead of waiting for it
+        self.cancel_stats()
+
+        materials = {}
+        for m in self.materials_dict.keys():
+            stats = {}
+            for s in self.materials_dict[m]['stats']:
+                if self.materials_dict[m]['stats'][s]['enabled']:
+                    stats[s] = self.materials_dict[m]['stats'][s]['function']
+            materials[m] = (self.materials_dict[m]['ID'], stats)
 
-        image = vtk_to_numpy(self.image.GetPointData().GetScalars()).reshape(self.image.GetDimensions(),order='F')
-        mask = vtk_to_numpy(self.mask.GetPointData().GetScalars()).reshape(self.mask.GetDimensions(),order='F')
+        if self.attenuation_grid is None:
+            self.attenuation_grid = ogo.icAttenuationGrid()
+        calibration = ([self.materials_dict[m]['ID'] for m in ('Air', 'Cortical Bone', 'Skeletal Muscle')], self.attenuation_grid)
 
-        print(f'Took {time.time()-start_time:0.2f} to convert to numpy')
+        worker = StatsWorker(self.label_stats, self.image_array, self.mask, materials, mask_path, calibration, self)
+        worker.mask_loaded.connect(lambda mask, w=worker: self._on_mask_loaded(w, mask))
+        worker.calibration_preview.connect(lambda parameters, w=worker: self._on_calibration_preview(w, parameters))
+        worker.progress.connect(lambda value, w=worker: self._on_stats_progress(w, value))
+        worker.material_done.connect(lambda m, values, w=worker: self._on_material_done(w, m, values))
+        worker.finished.connect(lambda w=worker: self._on_stats_finished(w))
 
-        for m in self.materials_dict.keys():
+        self.stats_worker = worker
+        self.running_workers.add(worker)
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(True)
+        worker.start()
 
-            #roi = ogo.maskThreshold(self.mask, self.materials_dict[m]['ID'])
-            #data = ogo.applyMask(self.image, roi)
+    def cancel_stats(self):
 
-            for s in self.materials_dict[m]['stats']:
+        if self.stats_worker is not None:
+            self.stats_worker.cancel()
+            self.stats_worker = None
 
-                if self.materials_dict[m]['stats'][s]['enabled']:
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(False)
+
+    def _on_stats_progress(self, worker, value):
 
-                    mask_id = mask==self.materials_dict[m]['ID']
-                    masked_image = image[mask_id]
+        if worker is self.stats_worker:
+            self.progress_bar.setValue(value)
 
-                    self.materials_dict[m]['stats'][s]['value'] = \
-                        self.materials_dict[m]['stats'][s]['function'](image,mask_id,masked_image)
+    def _on_material_done(self, worker, m, values):
+
+        if worker is not self.stats_worker:
+            return
+
+        for s, value in values.items():
+            self.materials_dict[m]['stats'][s]['value'] = value
 
         self.update_material_tables()
 
+    def _on_calibration_preview(self, worker, parameters):
+
+        if worker is self.stats_worker:
+            self.calibration_preview = parameters
+            self.update_calibration_table()
+
+    def _on_stats_finished(self, worker):
+
+        # keep a reference to every worker until its thread has finished
+        self.running_workers.discard(worker)
+        worker.deleteLater()
+
+        if worker is self.stats_worker:
+            self.stats_worker = None
+            self.cancel_button.setEnabled(False)
+
+    def closeEvent(self, event):
+
+        self.cancel_stats()
+        self.pending_calibration = None
+        for worker in list(self.running_workers):
+            worker.wait()
+
+        super().closeEvent(event)
+
     def update_material_tables(self):
 
         for m in self.materials_dict.keys():
@@ -270,26 +680,23 @@ class MainWindow(QMainWindow):
                 self.materials_dict[m]['table'].setItem(i,1,QTableWidgetItem(f"{self.materials_dict[m]['stats'][s]['value']}"))
                 i += 1
 
+    def update_calibration_table(self):
+
+        self.calibration_table.setColumnCount(2)
+        self.calibration_table.setRowCount(len(self.calibration_preview_keys))
+        for i, key in enumerate(self.calibration_preview_keys):
+            value = self.calibration_preview[key] if self.calibration_preview else ''
+            self.calibration_table.setItem(i,0,QTableWidgetItem(key))
+            self.calibration_table.setItem(i,1,QTableWidgetItem(f"{value}"))
+
     def update_stats_flags(self):
         for s in self.stats_dict.keys():
             self.stats_dict[s]['enabled'] = self.stats_dict[s]['checkbox_widget'].isChecked()
             for m in self.materials_dict.keys():
                 self.materials_dict[m]['stats'][s]['enabled'] = self.stats_dict[s]['enabled']
 
-    def get_mean(self,image,mask_id,masked_image):
-        return np.mean(masked_image)
-
-    def get_std(self,image,mask_id,masked_image):
-        return np.std(masked_image)
-
-    def get_min(self,image,mask_id,masked_image):
-        return np.amin(masked_image)
-
-    def get_max(self,image,mask_id,masked_image):
-        return np.amax(masked_image)
-
-    def get_slices(self,image,mask_id,masked_image):
-        return list(np.unique(np.nonzero(mask_id)[2])+1)
+    def get_median(self,values,indices,dimensions):
+        return np.median(values) if values.size else np.nan
 
     def _start(self):
 
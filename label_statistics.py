@@ -0,0 +1,233 @@
+#####
+# label_statistics.py
+#
+# Label statistics engine used by the mask stats GUI. The image voxels of every
+# label of interest are gathered from a single pass over the mask, and every
+# statistic of every label is then computed from those voxels only.
+#
+# The engine is kept between mask reloads. On a reload only the slices whose
+# checksum changed are compared with the previous mask, and the voxels and
+# running sums (count, sum, sum of squares, min, max) of the affected labels
+# are updated from the changed voxels. Statistics of unchanged labels are
+# served from a cache.
+#
+# A per-slice occupancy index (voxel count and sum of every label in every z
+# slice) is kept up to date the same way, so per-slice questions (which slices
+# contain a label, per-slice means) are answered without touching the voxels.
+#
+# A statistic is either the name of a running moment ('count', 'sum',
+# 'sum of squares', 'min', 'max', 'mean', 'standard deviation'), 'slices' (the
+# 1-based z slices containing the label) or any function
+# f(values, indices, dimensions) where values are the image values of the label,
+# indices are their flat (VTK order, x fastest) voxel indices and dimensions
+# are the (x, y, z) image dimensions.
+#####
+
+import threading
+import zlib
+
+import numpy as np
+
+
+class LabelStatistics:
+
+    def __init__(self, labels):
+        """Creates the engine for the list of labels of interest."""
+        self.labels = list(labels)
+        self.lock = threading.Lock()
+        self.image = None
+        self.mask = None
+        self.dimensions = None
+
+    def update(self, image, mask, dimensions):
+        """Updates the label index to a new image and/or mask.
+        The index is built from scratch for a new image or new dimensions,
+        otherwise only the voxels that changed since the previous mask are used.
+        The first argument is the flat image array (VTK order).
+        The second argument is the flat mask array (VTK order).
+        The third argument is the (x, y, z) image dimensions.
+        Returns the set of labels whose voxels changed.
+        """
+        if image.size != mask.size:
+            raise ValueError("ERROR: image and mask dimensions do not match")
+
+        dimensions = tuple(dimensions)
+        checksums = self._slice_checksums(mask, dimensions)
+
+        if self.image is not image or self.dimensions != dimensions or self.mask.dtype != mask.dtype:
+            self._build(image, mask, dimensions)
+            self.checksums = checksums
+            return set(self.labels)
+
+        ##
+        # Find the changed voxels, looking only at slices with a different checksum
+        slice_size = dimensions[0]*dimensions[1]
+        changed = []
+        for k in np.flatnonzero(checksums != self.checksums):
+            start = k*slice_size
+            old = self.mask[start:start+slice_size]
+            new = mask[start:start+slice_size]
+            changed.append(np.flatnonzero(old != new) + start)
+        changed = np.concatenate(changed) if changed else np.zeros(0, dtype=np.intp)
+
+        old_labels = self.mask[changed]
+        new_labels = mask[changed]
+        self.mask = mask
+        self.checksums = checksums
+
+        changed_labels = set()
+        for label in self.labels:
+            removed = changed[old_labels == label]
+            added = changed[new_labels == label]
+            if removed.size or added.size:
+                self._update_label(label, removed, added)
+                changed_labels.add(label)
+
+        return changed_labels
+
+    def voxels(self, label):
+        """Returns the image values and flat voxel indices of the label."""
+        return self.groups[label]
+
+    def slices(self, label):
+        """Returns the 1-based z slices that contain the label."""
+        return list(np.flatnonzero(self.slice_counts(label)) + 1)
+
+    def slice_counts(self, label):
+        """Returns the number of voxels of the label in every z slice."""
+        return self.occupancy[:, self.columns[label]]
+
+    def slice_means(self, label):
+        """Returns the mean image value of the label in every z slice (NaN where
+        the slice does not contain the label)."""
+        counts = self.slice_counts(label)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, self.slice_sums[:, self.columns[label]] / counts, np.nan)
+
+    def moment(self, label, name):
+        """Returns a statistic of the label from its running sums."""
+        m = self.moments[label]
+        n = m['count']
+        if name in m:
+            return m[name] if n or name in ('count', 'sum', 'sum of squares') else np.nan
+        if name == 'mean':
+            return m['sum'] / n if n else np.nan
+        if name == 'standard deviation':
+            if not n:
+                return np.nan
+            mean = m['sum'] / n
+            return np.sqrt(max(m['sum of squares'] / n - mean*mean, 0.0))
+        raise KeyError("Unknown statistic '%s'" % name)
+
+    def compute(self, label, function):
+        """Computes one statistic of the label.
+        The first argument is the label.
+        The second argument is the name of a running moment or a function
+        f(values, indices, dimensions).
+        Returns the value of the statistic.
+        """
+        if function == 'slices':
+            return self.slices(label)
+        if isinstance(function, str):
+            return self.moment(label, function)
+
+        key = (label, function)
+        if key not in self.cache:
+            values, indices = self.voxels(label)
+            self.cache[key] = function(values, indices, self.dimensions)
+        return self.cache[key]
+
+    def _build(self, image, mask, dimensions):
+
+        self.image = image
+        self.mask = mask
+        self.dimensions = dimensions
+        self.cache = {}
+
+        ##
+        # One pass over the mask selects the voxels of all labels of interest, which
+        # are then grouped by label (a small sort, only over the selected voxels)
+        indices = np.flatnonzero(np.isin(mask, self.labels))
+        voxel_labels = mask[indices]
+        order = np.argsort(voxel_labels, kind='stable')
+        indices = indices[order]
+        voxel_labels = voxel_labels[order]
+        values = image[indices]
+
+        self.groups = {}
+        self.moments = {}
+        self.columns = {}
+        column = np.empty(indices.size, dtype=np.intp)
+        for j, label in enumerate(self.labels):
+            start = int(np.searchsorted(voxel_labels, label, 'left'))
+            end = int(np.searchsorted(voxel_labels, label, 'right'))
+            self.groups[label] = (values[start:end], indices[start:end])
+            self.columns[label] = j
+            column[start:end] = j
+            self._reset_moments(label)
+
+        ##
+        # Slices x labels occupancy, from one bincount over the selected voxels
+        n_slices = dimensions[2]
+        n_labels = len(self.labels)
+        bins = (indices // (dimensions[0]*dimensions[1])) * n_labels + column
+        self.occupancy = np.bincount(bins, minlength=n_slices*n_labels).reshape(n_slices, n_labels)
+        self.slice_sums = np.bincount(bins, weights=values, minlength=n_slices*n_labels).reshape(n_slices, n_labels)
+
+    def _reset_moments(self, label):
+
+        values = self.groups[label][0].astype(np.float64)
+        self.moments[label] = {
+            'count': values.size,
+            'sum': values.sum(),
+            'sum of squares': np.dot(values, values),
+            'min': values.min() if values.size else np.inf,
+            'max': values.max() if values.size else -np.inf
+        }
+
+    def _update_label(self, label, removed, added):
+
+        values, indices = self.groups[label]
+        keep = ~np.isin(indices, removed, assume_unique=True)
+        removed_values = self.image[removed].astype(np.float64)
+        added_values = self.image[added].astype(np.float64)
+
+        self.groups[label] = (
+            np.concatenate([values[keep], self.image[added]]),
+            np.concatenate([indices[keep], added])
+        )
+        for key in [key for key in self.cache if key[0] == label]:
+            del self.cache[key]
+
+        # per-slice occupancy only changes in the slices of the changed voxels
+        n_slices = self.dimensions[2]
+        slice_size = self.dimensions[0]*self.dimensions[1]
+        j = self.columns[label]
+        self.occupancy[:, j] += np.bincount(added // slice_size, minlength=n_slices)
+        self.occupancy[:, j] -= np.bincount(removed // slice_size, minlength=n_slices)
+        self.slice_sums[:, j] += np.bincount(added // slice_size, weights=added_values, minlength=n_slices)
+        self.slice_sums[:, j] -= np.bincount(removed // slice_size, weights=removed_values, minlength=n_slices)
+
+        ##
+        # Running sums only need the changed voxels. The min or max only needs the
+        # remaining voxels of the label when the removed voxels held it.
+        m = self.moments[label]
+        if removed_values.size and (removed_values.min() <= m['min'] or removed_values.max() >= m['max']):
+            self._reset_moments(label)
+            return
+
+        m['count'] += added_values.size - removed_values.size
+        m['sum'] += added_values.sum() - removed_values.sum()
+        m['sum of squares'] += np.dot(added_values, added_values) - np.dot(removed_values, removed_values)
+        if added_values.size:
+            m['min'] = min(m['min'], added_values.min())
+            m['max'] = max(m['max'], added_values.max())
+
+    @staticmethod
+    def _slice_checksums(mask, dimensions):
+
+        slice_size = dimensions[0]*dimensions[1]
+        return np.array([
+            zlib.crc32(mask[k*slice_size:(k+1)*slice_size])
+            for k in range(dimensions[2])
+        ], dtype=np.uint32)
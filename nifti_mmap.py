@@ -0,0 +1,190 @@
+#####
+# nifti_mmap.py
+#
+# Memory-mapped reader for uncompressed single file NIFTI-1 images (.nii).
+#
+# Only the 348 byte header is read; the voxel block is memory-mapped, so a
+# study is ready as soon as the header is parsed, only the pages that are used
+# are read, and processes working on the same file share them through the OS
+# page cache. The mapping is copy-on-write: writes to the data stay private to
+# the process and never reach the file.
+#
+# MappedNifti.data is the voxel block as stored on disk, indexed [x, y, z].
+# MappedNifti.toVTK() gives the same image vtkNIFTIImageReader would, without
+# copying the voxels (except for qfac = -1 files, whose slices the VTK reader
+# reverses).
+#
+# Note that a file should not be overwritten while it is mapped; reading pages
+# of a truncated file raises SIGBUS on Linux and macOS.
+#####
+
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from vtk_numpy_views import numpyToImage
+
+nifti_datatypes = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64
+}
+
+# (name, struct format, offset) of the NIFTI-1 header fields used here
+nifti_header_fields = (
+    ('sizeof_hdr', 'i', 0),
+    ('dim', '8h', 40),
+    ('datatype', 'h', 70),
+    ('bitpix', 'h', 72),
+    ('pixdim', '8f', 76),
+    ('vox_offset', 'f', 108),
+    ('scl_slope', 'f', 112),
+    ('scl_inter', 'f', 116),
+    ('qform_code', 'h', 252),
+    ('sform_code', 'h', 254),
+    ('quatern', '3f', 256),
+    ('qoffset', '3f', 268),
+    ('srow', '12f', 280),
+    ('magic', '4s', 344)
+)
+
+
+def readNiftiHeader(filename):
+    """Reads the header of a NIFTI-1 file.
+    The first argument is the file name.
+    Returns the header fields as a dictionary, plus 'byteorder'.
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(348)
+
+    if raw[:2] == b'\x1f\x8b':
+        raise ValueError("ERROR: compressed NIFTI files cannot be memory-mapped: " + filename)
+    if len(raw) < 348:
+        raise ValueError("ERROR: not a NIFTI-1 file: " + filename)
+
+    for byteorder in ('<', '>'):
+        if struct.unpack(byteorder + 'i', raw[:4])[0] == 348:
+            break
+    else:
+        raise ValueError("ERROR: not a NIFTI-1 file: " + filename)
+
+    header = OrderedDict()
+    header['byteorder'] = byteorder
+    for name, fmt, offset in nifti_header_fields:
+        value = struct.unpack_from(byteorder + fmt, raw, offset)
+        header[name] = value if len(value) > 1 else value[0]
+
+    if header['magic'] != b'n+1\x00':
+        raise ValueError("ERROR: only single file NIFTI-1 images (.nii) can be memory-mapped: " + filename)
+    if header['datatype'] not in nifti_datatypes:
+        raise ValueError("ERROR: unsupported NIFTI datatype %d in %s" % (header['datatype'], filename))
+
+    return header
+
+
+class MappedNifti:
+    """A memory-mapped NIFTI-1 image.
+    The first argument is the file name of an uncompressed .nii file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = readNiftiHeader(filename)
+
+        dim = self.header['dim']
+        shape = list(dim[1:1 + dim[0]])
+        while len(shape) > 3 and shape[-1] == 1:
+            shape.pop()
+        self.dimensions = tuple(shape)
+
+        pixdim = self.header['pixdim']
+        self.spacing = tuple(float(pixdim[i]) for i in range(1, 4))
+        self.qfac = -1.0 if pixdim[0] < 0 else 1.0
+        self.slope = self.header['scl_slope']
+        self.intercept = self.header['scl_inter']
+
+        dtype = np.dtype(nifti_datatypes[self.header['datatype']]).newbyteorder(self.header['byteorder'])
+        self.data = np.memmap(
+            filename,
+            dtype=dtype,
+            mode='c',
+            offset=int(self.header['vox_offset']),
+            shape=self.dimensions,
+            order='F'
+        )
+
+    def rotation(self):
+        """Returns the 3x3 rotation of the qform from the quaternion."""
+        b, c, d = (float(q) for q in self.header['quatern'])
+        a = np.sqrt(max(0.0, 1.0 - (b*b + c*c + d*d)))
+        return np.array([
+            [a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+            [2*(b*c + a*d), a*a + c*c - b*b - d*d, 2*(c*d - a*b)],
+            [2*(b*d - a*c), 2*(c*d + a*b), a*a + d*d - c*c - b*b]
+        ])
+
+    def qform(self):
+        """Returns the 4x4 qform matrix mapping voxel [x, y, z] of data to mm."""
+        matrix = np.eye(4)
+        matrix[:3, :3] = self.rotation() * np.array([self.spacing[0], self.spacing[1], self.qfac*self.spacing[2]])
+        matrix[:3, 3] = self.header['qoffset']
+        return matrix
+
+    def sform(self):
+        """Returns the 4x4 sform matrix mapping voxel [x, y, z] of data to mm."""
+        matrix = np.eye(4)
+        matrix[:3, :] = np.reshape(self.header['srow'], (3, 4))
+        return matrix
+
+    def affine(self):
+        """Returns the voxel to mm matrix of data: the sform if it is set, else
+        the qform if it is set, else the voxel spacing only."""
+        if self.header['sform_code'] > 0:
+            return self.sform()
+        if self.header['qform_code'] > 0:
+            return self.qform()
+        return np.diag(self.spacing + (1.0,))
+
+    def qformMatrix(self):
+        """Returns the qform of the image given by toVTK as a vtkMatrix4x4 (as
+        vtkNIFTIImageReader.GetQFormMatrix)."""
+        import vtk
+
+        rotation = self.rotation()
+        offset = np.array(self.header['qoffset'], dtype=np.float64)
+        if self.qfac < 0:
+            # the slices are reversed, so the first voxel is the last slice on disk
+            offset = offset - rotation[:, 2]*self.spacing[2]*(self.dimensions[2] - 1)
+
+        matrix = vtk.vtkMatrix4x4()
+        for i in range(3):
+            for j in range(3):
+                matrix.SetElement(i, j, rotation[i, j])
+            matrix.SetElement(i, 3, offset[i])
+        return matrix
+
+    def toVTK(self):
+        """Returns the image as vtkImageData, as vtkNIFTIImageReader reads it
+        (origin at zero, slices reversed when qfac is -1). The scalars share the
+        mapped memory unless the slices have to be reversed.
+        """
+        if len(self.dimensions) > 3:
+            raise ValueError("ERROR: only 3D NIFTI images can be wrapped as vtkImageData: " + self.filename)
+
+        data = self.data
+        if not data.dtype.isnative:
+            data = data.astype(data.dtype.newbyteorder('='))
+        while data.ndim < 3:
+            data = data[..., np.newaxis]
+        if self.qfac < 0:
+            data = data[:, :, ::-1]
+
+        return numpyToImage(data, self.spacing)
@@ -0,0 +1,97 @@
+#
+# This script performs internal calibration for a batch of studies without user interaction.
+# This method has been published as Michalski et al. (2020) "CT-based internal density calibration for opportunistic skeletal assessment using abdominal CT scans" Med Eng Phys
+# DOI: https://doi.org/10.1016/j.medengphy.2020.01.009
+#####
+#
+# Each study is an image (NIFTI or DICOM directory) and the matching ITK-SNAP
+# label mask (Air = 2, Cortical Bone = 4, Skeletal Muscle = 5). Studies are
+# spread over a process pool so that all cores on a node are used.
+#
+# usage: python ogo_IC_3Materials_batch.py --study image.nii mask.nii --study ...
+#        python ogo_IC_3Materials_batch.py --list studies.txt --workers 8
+#
+# The list file contains one study per line: the image path and the mask path
+# separated by a comma.
+#####
+
+script_version = 1.1
+
+import ogo_helper_3Materials_BoneMuscleAir as ogo
+import os
+import sys
+import argparse
+
+
+def readStudyList(fileName):
+    """Reads the (image, mask) pairs from a comma separated text file.
+    Blank lines and lines starting with # are skipped.
+    """
+    studies = []
+    with open(fileName, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            image, mask = [x.strip() for x in line.split(',')]
+            studies.append((image, mask))
+    return studies
+
+
+def checkStudies(studies):
+    """Checks from the headers only that every mask matches its image.
+    Returns the number of invalid studies.
+    """
+    invalid = 0
+    for image, mask in studies:
+        try:
+            info = ogo.validateMask(image, mask)
+            ogo.message("OK: %s" % image, "shape %s, spacing %s, %s, %.1f MB" % (
+                info['shape'], tuple(round(s, 4) for s in info['spacing']), info['dtype'], info['bytes'] / 2**20))
+        except (OSError, ValueError) as e:
+            invalid += 1
+            ogo.message("Invalid: %s" % image, str(e))
+    return invalid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch internal calibration of CT images.')
+    parser.add_argument('--study', nargs=2, action='append', default=[], metavar=('IMAGE', 'MASK'),
+                        help='image and mask of one study (can be repeated)')
+    parser.add_argument('--list', dest='study_list', default=None,
+                        help='text file with one "image,mask" pair per line')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--output', default=None,
+                        help='output directory (default: the directory of each image)')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the image and mask headers of every study')
+    args = parser.parse_args()
+
+    studies = [tuple(s) for s in args.study]
+    if args.study_list:
+        studies += readStudyList(args.study_list)
+
+    if not studies:
+        parser.error('no studies given, use --study or --list')
+
+    if args.check:
+        sys.exit(1 if checkStudies(studies) else 0)
+
+    output_directory = os.path.abspath(args.output) if args.output else None
+
+    ogo.message("Calibrating %d studies..." % len(studies))
+    results = ogo.icCalibrateBatch(studies, args.workers, output_directory, script_name=sys.argv[0], script_version=script_version)
+
+    failed = [study for study, result in results.items() if isinstance(result, Exception)]
+    ogo.message("Calibrated %d of %d studies." % (len(results) - len(failed), len(results)))
+    for image, mask in failed:
+        ogo.message("Failed: %s, %s" % (image, mask), str(results[(image, mask)]))
+
+    ogo.message("Please cite 'Michalski et al. 2020 Med Eng Phys' when using this analysis.")
+    ogo.message("https://doi.org/10.1016/j.medengphy.2020.01.009")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,29 +24,88 @@ import os
 import sys
 import time
 import datetime
-import math
-import pandas as pd
+import concurrent.futures
+import hashlib
+import json
+import tempfile
+import importlib
 import numpy as np
-from scipy import stats
-import scipy.interpolate as interp
-import SimpleITK as sitk
 import vtk
-# import vtkbone
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 from collections import OrderedDict
-from PyQt5.QtWidgets import QApplication, QWidget, QInputDialog, QLineEdit, QFileDialog
-from PyQt5.QtGui import QIcon
 import shutil
 
+import MassAttenuationTables as mat
+from nifti_mmap import MappedNifti
+from vtk_numpy_views import allocateImage, flatView, imageModified, imageView, numpyToImage
+
+
+class LazyModule:
+    """A module that is imported the first time one of its attributes is used.
+    The first argument is the module name (as for importlib.import_module).
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+##
+# Toolkits used only by some functions (registration, DICOM headers, table
+# interpolation, regression, finite element models and their morphology) are
+# imported on first use, so headless calibration and every batch worker start
+# without them
+pd = LazyModule('pandas')
+stats = LazyModule('scipy.stats')
+interp = LazyModule('scipy.interpolate')
+sitk = LazyModule('SimpleITK')
+vtkbone = LazyModule('vtkbone')
+morphology = LazyModule('distance_morphology')
+
 
 start_time = time.time()
 
+##
+# Reference materials and energy grid (start, stop, step in keV) used for internal calibration
+ic_materials = ('air', 'bone', 'muscle', 'k2hpo4', 'cha', 'triglyceride', 'water')
+ic_energy_grid = (1, 200.5, 0.5)
+ic_cache_version = 1
+_ic_grid = {}
+_dicom2nifti_cache = OrderedDict([('hits', 0), ('misses', 0)])
+_background_writer = None
+
+##
+# Density-elastic modulus laws for the FE material table, by name. Each law is
+# f(density, *parameters) with the density in [g/cc] and the modulus in [MPa].
+#   'power':     (Emax, exponent), E = Emax * density^exponent
+#   'piecewise': (segments,), a power law per density range (see piecewisePowerLaw)
+# Site specific trabecular power laws (Emax, exponent) of Morgan et al. (2003)
+# "Trabecular bone modulus-density relationships depend on anatomic site" J Biomech
+morgan_2003_laws = OrderedDict([
+    ('pooled', (8920.0, 1.83)),
+    ('vertebra', (4730.0, 1.56)),
+    ('proximal tibia', (15520.0, 1.93)),
+    ('greater trochanter', (15010.0, 2.18)),
+    ('femoral neck', (6850.0, 1.49))
+])
+_density_modulus = {}
+
+##
+# Final transforms of registrationTransform, by cache file name (the files
+# persist them between runs, this keeps them for the rest of the process)
+_registration_cache = {}
+
 ##
 # Functions for Ogo Calibration Scripts
-def applyInternalCalibration(imageData, cali_parameters):
+def applyInternalCalibration(imageData, cali_parameters, slab_thickness=16):
     """ Applies the internal calibration to the image.
     The first argument is the image.
     The second argument is a dictionary of the calibration parameters.
+    The third argument is the number of slices processed at a time.
     Returns the calibrated image in mg/cc.
     """
     ##
@@ -54,8 +113,7 @@ def applyInternalCalibration(imageData, cali_parameters):
     extent = imageData.GetExtent()
     origin = imageData.GetOrigin()
     spacing = imageData.GetSpacing()
-    voxel_volume_mm = spacing[0] * spacing[1] * spacing[2] # [mm^3]
-    voxel_volume_cm = voxel_volume_mm / 1000 # [cm^3]
+    dimensions = imageData.GetDimensions()
     HU_MassAtten_Slope = cali_parameters['HU-u/p Slope']
     HU_MassAtten_Yint = cali_parameters['HU-u/p Y-Intercept']
     HU_Den_Slope = cali_parameters['HU-Material Density Slope']
@@ -64,77 +122,44 @@ def applyInternalCalibration(imageData, cali_parameters):
     K2HPO4_Mass_Atten = cali_parameters['K2HPO4 u/p']
 
     ##
-    # Create copies of the image data for Output density Images and convert to numpy arrays
-    # Mass Attenuation Reference Image
-    Mass_Atten_image = vtk.vtkImageData()
-    Mass_Atten_image.SetExtent(extent)
-    Mass_Atten_image.SetOrigin(origin)
-    Mass_Atten_image.SetSpacing(spacing)
-    Mass_Atten_image.AllocateScalars(vtk.VTK_FLOAT, 1)
-    Mass_Atten_data = vtk2numpy(Mass_Atten_image)
+    # Create the output density images. The calibration is written directly into
+    # their scalars, so no other full size image is allocated.
+    # K2HPO4 Density
+    K2HPO4_den_image = allocateImage(imageData, vtk.VTK_FLOAT)
+    K2HPO4_den_data = flatView(K2HPO4_den_image)
 
     # Archimedean Density Reference Image
-    Arch_den_image = vtk.vtkImageData()
-    Arch_den_image.SetExtent(extent)
-    Arch_den_image.SetOrigin(origin)
-    Arch_den_image.SetSpacing(spacing)
-    Arch_den_image.AllocateScalars(vtk.VTK_FLOAT, 1)
-    Arch_den_data = vtk2numpy(Arch_den_image)
-
-    # Mass Attenuation Reference Image
-    Mass_image = vtk.vtkImageData()
-    Mass_image.SetExtent(extent)
-    Mass_image.SetOrigin(origin)
-    Mass_image.SetSpacing(spacing)
-    Mass_image.AllocateScalars(vtk.VTK_FLOAT, 1)
-    Mass_data = vtk2numpy(Mass_image)
-
-    # K2HPO4 Density
-    K2HPO4_den_image = vtk.vtkImageData()
-    K2HPO4_den_image.SetExtent(extent)
-    K2HPO4_den_image.SetOrigin(origin)
-    K2HPO4_den_image.SetSpacing(spacing)
-    K2HPO4_den_image.AllocateScalars(vtk.VTK_FLOAT, 1)
-    K2HPO4_den_data = vtk2numpy(K2HPO4_den_image)
+    Arch_den_image = allocateImage(imageData, vtk.VTK_FLOAT)
+    Arch_den_data = flatView(Arch_den_image)
 
-    ##
-    # Convert image to NumPy
-    message("Converting image to NumPy...")
-    numpy_image = vtk2numpy(imageData)
+    numpy_image = flatView(imageData)
 
     ##
-    # Apply HU to Mass Attenuation Conversion
-    message("Converting image to mass attenuation equivalent...")
-    Mass_Atten_data[:,:,:] = ((HU_MassAtten_Slope * numpy_image) + HU_MassAtten_Yint)
-
-    # Apply HU to Archimedean Density Conversion
-    message("Converting image to Archimedean density equivalent...")
-    Arch_den_data[:,:,:] = ((HU_Den_Slope * numpy_image) + HU_Den_Yint)
-
-    # Convert Archimedean density to total mass equivalent
-    message("Converting Archimedean density equivalent to Mass equivalent image...")
-    Mass_data[:,:,:] = Arch_den_data * voxel_volume_cm
-
-    # Converting onverting to K2HPO4 Mass
-    message("Converting to K2HPO4 Mass Image...")
-    K2HPO4_mass_seg_data = np.zeros_like(Mass_data, dtype = 'h')
-
-    # Two component model to derive K2HPO4 mass image
-    K2HPO4_mass_seg_data = (Mass_data *((Mass_Atten_data - Triglyceride_Mass_Atten) / (K2HPO4_Mass_Atten - Triglyceride_Mass_Atten)))
-
-
-    # Converting mass images to density images
-    message("Converting K2HPO4 mass images to K2HPO4 density images...")
-    K2HPO4_den_data = K2HPO4_mass_seg_data / voxel_volume_cm * 1000 # *1000 to convert g to mg
-
-    # Convery Numpy images back to vtk Image
-    scalars = K2HPO4_den_data.flatten(order='C')
-    VTK_data = numpy_to_vtk(num_array=scalars, deep=True, array_type=vtk.VTK_FLOAT)
-    K2HPO4_den_image.GetPointData().SetScalars(VTK_data)
-
-    scalars2 = Arch_den_data.flatten(order='C')
-    VTK_data2 = numpy_to_vtk(num_array=scalars2, deep=True, array_type=vtk.VTK_FLOAT)
-    Arch_den_image.GetPointData().SetScalars(VTK_data2)
+    # Process the image in slabs of slices (contiguous in VTK memory order)
+    message("Converting image to Archimedean and K2HPO4 density...")
+    slab_size = dimensions[0] * dimensions[1] * max(1, int(slab_thickness))
+    mass_atten = np.empty(slab_size, dtype=np.float64)
+    two_component = 1000.0 / (K2HPO4_Mass_Atten - Triglyceride_Mass_Atten)
+    for start in range(0, numpy_image.size, slab_size):
+        stop = min(start + slab_size, numpy_image.size)
+        hu = numpy_image[start:stop]
+        arch = Arch_den_data[start:stop]
+        k2hpo4 = K2HPO4_den_data[start:stop]
+        ma = mass_atten[:stop-start]
+
+        # HU to Archimedean density and HU to mass attenuation
+        np.multiply(hu, HU_Den_Slope, out=arch, casting='same_kind')
+        np.add(arch, HU_Den_Yint, out=arch)
+        np.multiply(hu, HU_MassAtten_Slope, out=ma, casting='same_kind')
+        np.add(ma, HU_MassAtten_Yint - Triglyceride_Mass_Atten, out=ma)
+
+        # Two component model to derive K2HPO4 density in mg/cc. The voxel volume
+        # used to convert density to mass and back cancels out.
+        np.multiply(ma, two_component, out=ma)
+        np.multiply(arch, ma, out=k2hpo4, casting='same_kind')
+
+    imageModified(K2HPO4_den_image)
+    imageModified(Arch_den_image)
 
     return K2HPO4_den_image, Arch_den_image
 
@@ -193,22 +218,14 @@ def applyTestBase(mesh, material_table):
 
 def applyTransform(vtk_image, matrix):
     """Applies the transform matrix to the image.
+    To apply several transforms (e.g. a pre-rotation, an ICP matrix and a
+    readTransform matrix), combine them with composeTransforms first so the
+    image is resampled only once.
     The first argument is the vtk image data.
-    The second argument is the 4x4 rotation matrix.
+    The second argument is the 4x4 rotation matrix (or a vtkTransform).
     Returns the transformed image.
     """
-    transform = vtk.vtkTransform()
-    transform.SetMatrix(matrix)
-    transform.Update()
-
-    reslice = vtk.vtkImageReslice()
-    reslice.SetInputData(vtk_image)
-    reslice.SetInterpolationModeToCubic()
-    reslice.SetResliceTransform(transform)
-    reslice.AutoCropOutputOn()
-    reslice.Update()
-
-    return reslice.GetOutput()
+    return resliceImage(vtk_image, matrix, 'cubic', auto_crop=True)
 
 def bmd_CHAToAsh(vtk_image):
     """Converts CHA density to ash density using equation from:
@@ -317,6 +334,29 @@ def changeInfo(vtk_image):
     change.Update()
     return change.GetOutput()
 
+def coronalQFormMatrix():
+    """Creates the qform matrix used when writing the coronal NIFTI images.
+    Returns the 4x4 orientation matrix.
+    """
+    orientation_mat = vtk.vtkMatrix4x4()
+    orientation_mat.SetElement(0,0,1)
+    orientation_mat.SetElement(0,1,0)
+    orientation_mat.SetElement(0,2,0)
+    orientation_mat.SetElement(0,3,0)
+    orientation_mat.SetElement(1,0,0)
+    orientation_mat.SetElement(1,1,0)
+    orientation_mat.SetElement(1,2,1)
+    orientation_mat.SetElement(1,3,0)
+    orientation_mat.SetElement(2,0,0)
+    orientation_mat.SetElement(2,1,1)
+    orientation_mat.SetElement(2,2,0)
+    orientation_mat.SetElement(2,3,0)
+    orientation_mat.SetElement(3,0,0)
+    orientation_mat.SetElement(3,1,0)
+    orientation_mat.SetElement(3,2,0)
+    orientation_mat.SetElement(3,3,0)
+    return orientation_mat
+
 def combineImageData_SF(image, fh_pmma_id_pad, gt_pmma_id_pad, pmma_mat_id):
     """Combines the 3 image data together to get final image.
     The first argument is the original image data.
@@ -517,6 +557,59 @@ def combineImageData_VC(image, sup_pmma_id_pad, inf_pmma_id_pad, pmma_mat_id):
 
     return final_image
 
+def composeTransforms(*transforms):
+    """Concatenates reslice transforms into a single transform, so that a volume
+    resliced with it is resampled once instead of once per transform.
+    The arguments are vtkMatrix4x4 or vtkLinearTransform objects, in the order
+    in which the volume would have been resliced with them (e.g. the
+    pre-rotation, then the ICP matrix, then a readTransform matrix).
+    Returns the vtkTransform.
+    """
+    ##
+    # A reslice transform maps output points to input points, so reslicing with
+    # A and then with B samples the input at A(B(x)): the transforms are
+    # concatenated in pre-multiply order.
+    transform = vtk.vtkTransform()
+    transform.PreMultiply()
+    for t in transforms:
+        transform.Concatenate(t)
+    transform.Update()
+    return transform
+
+def densityModulus(max_id, law='power', parameters=None, den_bin_step=0.001):
+    """Computes the elastic modulus of every material ID of an FE model, where
+    material ID i has the density i * den_bin_step [g/cc].
+    The arrays are kept, so models with the same law, parameters and bin step
+    reuse them (and only a model with a larger maximum ID extends them).
+    The first argument is the maximum material ID.
+    The second argument is the name of the density-elastic modulus law ('power' or 'piecewise').
+    The third argument are the parameters of the law: (Emax, exponent) for
+    'power', (segments,) for 'piecewise'.
+    The fourth argument is the density step between material IDs [g/cc].
+    Returns the float32 array of elastic moduli [MPa] for IDs 0 to max_id (ID 0 is 1.0).
+    The array is shared, so it must not be modified.
+    """
+    # name: (law, parameter names)
+    laws = {
+        'power': (powerLaw, ('Emax', 'exponent')),
+        'piecewise': (piecewisePowerLaw, ('segments',))
+        }
+    if law not in laws:
+        raise ValueError("ERROR: unknown density-elastic modulus law '%s', expected one of: %s" % (law, ', '.join(laws)))
+    function, names = laws[law]
+    if parameters is None or len(parameters) != len(names):
+        raise ValueError("ERROR: the '%s' density-elastic modulus law needs the parameters (%s), got %r" % (law, ', '.join(names), parameters))
+
+    key = (law, repr(parameters), den_bin_step)
+    modulus = _density_modulus.get(key)
+    if modulus is None or modulus.size < max_id + 1:
+        density = np.arange(max_id + 1) * den_bin_step
+        modulus = np.asarray(function(density, *parameters), dtype=np.float64).astype(np.float32)
+        modulus[0] = 1.0
+        modulus.flags.writeable = False
+        _density_modulus[key] = modulus
+    return modulus[:max_id + 1]
+
 def extractBox(extraction_bounds, model):
     """Extracts the geometry within the specific bounds.
     The first argument are the extraction bounds of the box.
@@ -556,18 +649,8 @@ def femoralHeadPMMA(femoral_head_model_bounds, spacing, origin, inval, outval, t
     fh_pmma_id.AllocateScalars(vtk.VTK_SHORT, 1)
 
     ##
-    # Create numpy array of PMMA cap to convert to vtkImageData
-    fh_pmma_np = np.empty(fh_pmma_id.GetDimensions())
-    fh_pmma_np.fill(inval)
-
-    ##
-    # Import Numpy array to vtk
-    vtk_data = numpy_to_vtk(
-        num_array=fh_pmma_np.ravel(),
-        deep=True,
-        array_type=vtk.VTK_SHORT
-    )
-    fh_pmma_id.GetPointData().SetScalars(vtk_data)
+    # Fill the PMMA cap directly in its scalars
+    flatView(fh_pmma_id).fill(inval)
 
     ##
     # Pad Image with extra thickness
@@ -608,18 +691,8 @@ def femoralHeadPMMA_SLS(femoral_head_model_bounds, spacing, origin, inval, outva
     fh_pmma_id.AllocateScalars(vtk.VTK_SHORT, 1)
 
     ##
-    # Create numpy array of PMMA cap to convert to vtkImageData
-    fh_pmma_np = np.empty(fh_pmma_id.GetDimensions())
-    fh_pmma_np.fill(inval)
-
-    ##
-    # Import Numpy array to vtk
-    vtk_data = numpy_to_vtk(
-        num_array=fh_pmma_np.ravel(),
-        deep=True,
-        array_type=vtk.VTK_SHORT
-    )
-    fh_pmma_id.GetPointData().SetScalars(vtk_data)
+    # Fill the PMMA cap directly in its scalars
+    flatView(fh_pmma_id).fill(inval)
 
     ##
     # Pad Image with extra thickness
@@ -639,97 +712,38 @@ def femoralHeadPMMA_SLS(femoral_head_model_bounds, spacing, origin, inval, outva
     fh_pmma_id_pad.Update()
     return fh_pmma_id_pad.GetOutput()
 
-def finalRegistration(ref_image):
-    """Performs final 3D image registration in SimpleITK.
-    The first argument is the image.
-    The second argument is the mask image (used for registration).
-    The third argument is the reference image.
-    Returns the transformed image and mask as VTKImageData.
+def finalRegistration(ref_image, image="temp_image.nii", mask="temp_mask.nii", output_image="temp_image2.nii", output_mask="temp_mask2.nii", number_of_threads=None, sampling_percentage=0.01, use_cache=False, cache_dir=None):
+    """Performs final 3D image registration in SimpleITK on image files (see
+    registerImages for the registration itself).
+    The first argument is the reference image file.
+    The second argument is the image file to transform.
+    The third argument is the mask file (used for registration).
+    The fourth and fifth arguments are the output image and mask files.
+    The remaining arguments are passed to registerImages.
+    The input image and mask files are removed.
+    Returns the final transform.
     """
-
     fixed_image = sitk.ReadImage(ref_image, sitk.sitkFloat32)
-    moving_image = sitk.ReadImage("temp_mask.nii", sitk.sitkFloat32)
-    trans_image = sitk.ReadImage("temp_image.nii", sitk.sitkFloat32)
-
-    message("Performing initial registration transform...")
-    initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                      moving_image,
-                                                      sitk.Euler3DTransform(),
-                                                      sitk.CenteredTransformInitializerFilter.MOMENTS
-                                                      )
-    moving_resampled = sitk.Resample(
-        moving_image,
-        fixed_image,
-        initial_transform,
-        sitk.sitkLinear,
-        0.0,
-        moving_image.GetPixelIDValue()
+    moving_image = sitk.ReadImage(mask, sitk.sitkFloat32)
+    trans_image = sitk.ReadImage(image, sitk.sitkFloat32)
+
+    moving_thres, org_trans, final_transform = registerImages(
+        fixed_image, moving_image, trans_image,
+        number_of_threads=number_of_threads,
+        sampling_percentage=sampling_percentage,
+        use_cache=use_cache,
+        cache_dir=cache_dir
         )
 
-    message("Setting up registration parameters...")
-    registration_method = sitk.ImageRegistrationMethod()
-    registration_method.SetMetricAsJointHistogramMutualInformation(
-        numberOfHistogramBins=100
-        )
-    registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-    registration_method.SetMetricSamplingPercentage(0.01)
-    registration_method.SetInterpolator(sitk.sitkLinear)
-    registration_method.SetOptimizerAsGradientDescent(
-        learningRate=1.0,
-        numberOfIterations=100,
-        convergenceMinimumValue=1e-6,
-        convergenceWindowSize=10
-        )
-    registration_method.SetOptimizerScalesFromPhysicalShift()
-    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
-    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
-    registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-    registration_method.SetInitialTransform(initial_transform,
-        inPlace=False
-        )
-
-    message("Executing the registration...")
-    final_transform = registration_method.Execute(sitk.Cast(fixed_image,
-        sitk.sitkFloat32),
-        sitk.Cast(moving_image,
-        sitk.sitkFloat32)
-        )
-    message("Registration complete...")
-
-    print(('Final metric value: {0}'.format(registration_method.GetMetricValue())))
-    print(('Optimizer\'s stopping condition, {0}'.format(
-    registration_method.GetOptimizerStopConditionDescription())))
-
-    message("Resampling the images...")
-    moving_resampled = sitk.Resample(moving_image,
-        fixed_image,
-        final_transform,
-        sitk.sitkLinear,
-        0.0,
-        moving_image.GetPixelIDValue()
-        )
-    moving_thres = sitk.BinaryThreshold(moving_resampled,
-        lowerThreshold=0.01,
-        insideValue=1,
-        outsideValue=0
-        )
-
-    org_trans = sitk.Resample(trans_image,
-    fixed_image,
-    final_transform,
-    sitk.sitkBSpline,
-    0.0,
-    trans_image.GetPixelIDValue()
-    )
-
     message("Writing out temp images...")
-    sitk.WriteImage(moving_thres, "temp_mask2.nii")
-    sitk.WriteImage(org_trans, "temp_image2.nii")
+    sitk.WriteImage(moving_thres, output_mask)
+    sitk.WriteImage(org_trans, output_image)
 
     message("Removing temporary files...")
-    os.remove("temp_image.nii")
-    os.remove("temp_mask.nii")
+    os.remove(image)
+    os.remove(mask)
 
+    return final_transform
 
 def greaterTrochanterPMMA(greater_trochanter_model_bounds, spacing, origin, inval, outval, thickness, pmma_mat_id):
     """Creates the image data for the greater trochanter PMMA cap.
@@ -751,18 +765,8 @@ def greaterTrochanterPMMA(greater_trochanter_model_bounds, spacing, origin, inva
     gt_pmma_id.SetOrigin(origin)
     gt_pmma_id.AllocateScalars(vtk.VTK_SHORT, 1)
 
-    # Create numpy array of PMMA cap to convert to vtkImageData
-    gt_pmma_np = np.empty(gt_pmma_id.GetDimensions())
-    gt_pmma_np.fill(inval)
-
-    ##
-    # Import Numpy array to vtk
-    vtk_data3 = numpy_to_vtk(
-        num_array=gt_pmma_np.ravel(),
-        deep=True,
-        array_type=vtk.VTK_SHORT
-    )
-    gt_pmma_id.GetPointData().SetScalars(vtk_data3)
+    # Fill the PMMA cap directly in its scalars
+    flatView(gt_pmma_id).fill(inval)
 
     ##
     # Pad iamge with extra thickness
@@ -781,62 +785,330 @@ def greaterTrochanterPMMA(greater_trochanter_model_bounds, spacing, origin, inva
     gt_pmma_id_pad.Update()
     return gt_pmma_id_pad.GetOutput()
 
+def icAttenuationGrid(cache_dir=None):
+    """Loads (or builds and stores) the interpolated mass attenuation of all
+    internal calibration materials on the energy grid.
+    The first argument is the cache directory (defaults to $OGO_CACHE_DIR or ~/.cache/ogo).
+    Returns an array with the energies in the first row followed by one row per material.
+    """
+    cache_dir = _cacheDirectory(cache_dir)
+
+    ##
+    # Key the cache on the source tables, the energy grid and the cache version
+    key = hashlib.sha1()
+    key.update(repr((ic_cache_version, ic_energy_grid, ic_materials)).encode())
+    for material in ic_materials:
+        energy, attenuation = mat.get(material)
+        key.update(energy.tobytes())
+        key.update(attenuation.tobytes())
+    fileName = os.path.join(cache_dir, 'ic_attenuation_grid_%s.npy' % key.hexdigest()[:16])
+
+    if fileName in _ic_grid:
+        return _ic_grid[fileName]
+
+    if os.path.exists(fileName):
+        grid = np.load(fileName, mmap_mode='r')
+    else:
+        message("Building the interpolated material tables cache...")
+        energies = np.arange(*ic_energy_grid)
+        grid = np.empty((len(ic_materials)+1, len(energies)))
+        grid[0] = energies
+        for i, material in enumerate(ic_materials):
+            energy, attenuation = mat.get(material)
+            grid[i+1] = interp.griddata(energy, attenuation, energies, method = 'linear')
+
+        # Write to a temporary file first so concurrent workers never read a partial cache
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_fileName = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, grid)
+            os.replace(tmp_fileName, fileName)
+        except OSError as e:
+            message("WARNING: could not write the material tables cache", str(e))
+
+    _ic_grid[fileName] = grid
+    return grid
+
+def icCalibrateBatch(studies, max_workers=None, output_directory=None, orientation_mat=None, script_name=None, script_version=None, mp_context=None):
+    """Runs the internal calibration for a list of studies over a process pool.
+    The first argument is a list of (image, mask) file path pairs.
+    The second argument is the number of worker processes (defaults to the number of CPUs).
+    The remaining arguments are passed on to icCalibrateStudy for every study.
+    Images and masks are memory-mapped, so workers share their pages through the OS cache.
+    Returns a dictionary of the calibration parameters for each (image, mask) study.
+    Studies that failed hold the raised exception instead. A study listed more
+    than once is calibrated once.
+    """
+    results = OrderedDict()
+    for study in studies:
+        if tuple(study) in results:
+            message("Study listed more than once, calibrated once: %s, %s" % tuple(study))
+        results[tuple(study)] = None
+
+    ##
+    # Validate every study from its headers before any worker starts (the largest
+    # studies are submitted first so a big one does not end up running alone at the end)
+    sizes = OrderedDict()
+    for image, mask in results:
+        try:
+            sizes[(image, mask)] = validateMask(image, mask)['bytes']
+        except (OSError, ValueError) as e:
+            results[(image, mask)] = e
+            message("ERROR: invalid study %s, %s" % (image, mask), str(e))
+
+    ##
+    # Studies whose output files would overwrite each other (one image with two
+    # masks, or images with the same name written to one output directory) are
+    # all rejected, so no result silently replaces another. Studies that already
+    # failed validation never run, so they do not clash with anything.
+    outputs = OrderedDict()
+    for image, mask in sizes:
+        for fileName in icOutputFiles(image, output_directory):
+            outputs.setdefault(os.path.normcase(fileName), []).append((image, mask))
+    for fileName, clashing in outputs.items():
+        if len(clashing) < 2:
+            continue
+        for image, mask in clashing:
+            if results[(image, mask)] is None:
+                results[(image, mask)] = ValueError(
+                    "ERROR: output file %s is also written by: %s" % (fileName, '; '.join(
+                        '%s, %s' % other for other in clashing if other != (image, mask))))
+                message("ERROR: invalid study %s, %s" % (image, mask), str(results[(image, mask)]))
+            sizes.pop((image, mask), None)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+        futures = OrderedDict()
+        for image, mask in sorted(sizes, key=sizes.get, reverse=True):
+            futures[executor.submit(icCalibrateStudy, image, mask, output_directory, orientation_mat, script_name, script_version, True)] = (image, mask)
+
+        for future in concurrent.futures.as_completed(futures):
+            study = futures[future]
+            try:
+                results[study] = future.result()
+                message("Finished internal calibration: %s, %s" % study)
+            except Exception as e:
+                results[study] = e
+                message("ERROR: internal calibration failed for %s, %s" % study, str(e))
+
+    return results
+
+def icCalibrateStudy(image, mask, output_directory=None, orientation_mat=None, script_name=None, script_version=None, mmap=False, imageData=None):
+    """Runs the full internal calibration for a single study without any user interaction.
+    The first argument is the image file (NIFTI) or DICOM directory.
+    The second argument is the mask file (NIFTI) or DICOM directory.
+    The third argument is the output directory (defaults to the image directory).
+    The fourth argument is the qform matrix for the output images (defaults to coronalQFormMatrix).
+    The fifth and sixth arguments are the script name and version written to the parameters file.
+    The seventh argument memory-maps the image and mask instead of reading them
+    (only for files that are not being edited, see readNii).
+    The eighth argument is the image when it is already in memory (e.g. from
+    dicom2image), the image file is then not read.
+    Returns the calibration parameters as a dictionary.
+    """
+    message("Start of Internal Calibration...")
+
+    ##
+    # Determine image locations and names of files. Paths are made absolute since
+    # the writers change the working directory.
+    image = os.path.abspath(image)
+    mask = os.path.abspath(mask)
+    image_pathname = os.path.dirname(image)
+    image_basename = os.path.basename(image)
+    mask_pathname = os.path.dirname(mask)
+    mask_basename = os.path.basename(mask)
+    org_fileName = image_basename.replace(".nii","")
+    fileName, fileName2, txt_fileName = [os.path.basename(f) for f in icOutputFiles(image, output_directory)]
+    if output_directory is None:
+        output_directory = image_pathname
+    if orientation_mat is None:
+        orientation_mat = coronalQFormMatrix()
+    if script_name is None:
+        script_name = sys.argv[0]
+
+    ##
+    # Read input image and mask with correct reader
+    if imageData is None:
+        message("Reading input image...")
+        imageData = readImage(image, mmap)
+    message("Reading input mask image...")
+    maskData = readImage(mask, mmap)
+
+    ##
+    # Extract reference tissues from the mask
+    # Using only 3 reference tissues (air, bone, and muscle)
+    message("Extracting reference tissues: Air, Cortical Bone, Skeletal Muscle...")
+    roi_stats = labelStatistics(imageData, maskData, [2, 4, 5])
+    air_HU = roi_stats[2]['mean']
+    bone_HU = roi_stats[4]['mean']
+    muscle_HU = roi_stats[5]['mean']
+
+    mean_hu = [air_HU, bone_HU, muscle_HU]
+
+    ##
+    # Prep Reference Material Tables with interpolation over energy levels 1-200 keV
+    message("Deriving material tables...")
+    grid = icAttenuationGrid()
+
+    ##
+    # Determine the scan effective energy, the HU-Mass Attenuation and HU-Material
+    # Density relationships
+    message("Determining the scan effective energy and HU relationships...")
+    ic_parameters = icCalibrationParameters(mean_hu, grid)
+
+    ##
+    # Compile the calibration parameters
+    message("Compiling the internal calibration parameters...")
+    cali_parameters = OrderedDict()
+    cali_parameters['ID'] = org_fileName
+    cali_parameters['Output File'] = fileName
+    cali_parameters['Python Script'] = script_name
+    cali_parameters['Version'] = script_version
+    cali_parameters['Date Created'] = str(datetime.date.today())
+    cali_parameters['Image Directory'] = image_pathname
+    cali_parameters['Image'] = image_basename
+    cali_parameters['Mask Directory'] = mask_pathname
+    cali_parameters['Mask'] = mask_basename
+    cali_parameters['+++++'] = '+++++'
+    cali_parameters['Effective Energy [keV]'] = ic_parameters['Effective Energy [keV]']
+    cali_parameters['Max R^2'] = ic_parameters['Max R^2']
+    cali_parameters['HU-u/p Slope'] = ic_parameters['HU-u/p Slope']
+    cali_parameters['HU-u/p Y-Intercept'] = ic_parameters['HU-u/p Y-Intercept']
+    cali_parameters['HU-Material Density Slope'] = ic_parameters['HU-Material Density Slope']
+    cali_parameters['HU-Material Density Y-Intercept'] = ic_parameters['HU-Material Density Y-Intercept']
+    cali_parameters['Air u/p'] = ic_parameters['Air u/p']
+    cali_parameters['Cortical Bone u/p'] = ic_parameters['Cortical Bone u/p']
+    cali_parameters['Skeletal Muscle u/p'] = ic_parameters['Skeletal Muscle u/p']
+    cali_parameters['K2HPO4 u/p'] = ic_parameters['K2HPO4 u/p']
+    cali_parameters['CHA u/p'] = ic_parameters['CHA u/p']
+    cali_parameters['Triglyceride u/p'] = ic_parameters['Triglyceride u/p']
+    cali_parameters['Water u/p'] = ic_parameters['Water u/p']
+
+    # Write the output text file
+    message("Writing parameters to output text file: %s" % txt_fileName)
+    writeTXTfile(cali_parameters, txt_fileName, output_directory)
+
+    ##
+    # Apply the internal density calibration to the image
+    message("Applying the calibration to the image...")
+    calibrated_image, ARCH_image = applyInternalCalibration(imageData, cali_parameters)
+
+    ##
+    # Write out calibrated image
+    message("Writing out the K2HPO4 calibrated image: %s" % fileName)
+    writeNii(calibrated_image, fileName, output_directory, orientation_mat)
+    message("Writing out the Archimedean calibrated image: %s" % fileName2)
+    writeNii(ARCH_image, fileName2, output_directory, orientation_mat)
+
+    return cali_parameters
+
+def icCalibrationParameters(HU_array, grid):
+    """Derives the internal calibration from the mean HU of the reference tissues.
+    The first argument is the mean HU of air, cortical bone and skeletal muscle.
+    The second argument is the interpolated attenuation grid from icAttenuationGrid.
+    Returns the effective energy parameters (see icEffectiveEnergyGrid), the
+    HU-mass attenuation and HU-material density regressions and the material
+    densities as a dictionary.
+    """
+    air_HU, bone_HU, muscle_HU = HU_array
+    ic_parameters = icEffectiveEnergyGrid(HU_array, grid)
+
+    ##
+    # Determine the HU-Mass Attenuation Relationship
+    attenuation_values = [ic_parameters['Air u/p'], ic_parameters['Cortical Bone u/p'], ic_parameters['Skeletal Muscle u/p']]
+    ic_parameters.update(icLinearRegression(HU_array, attenuation_values, 'HU-u/p Slope', 'HU-u/p Y-Intercept'))
+
+    ##
+    # Determine the material densities and the HU-density relationship
+    air_den = icMaterialDensity(air_HU, ic_parameters['Air u/p'], ic_parameters['Water u/p'], 1.0)
+    bone_den = icMaterialDensity(bone_HU, ic_parameters['Cortical Bone u/p'], ic_parameters['Water u/p'], 1.0)
+    muscle_den = icMaterialDensity(muscle_HU, ic_parameters['Skeletal Muscle u/p'], ic_parameters['Water u/p'], 1.0)
+    material_densities = [air_den, bone_den, muscle_den]
+    ic_parameters.update(icLinearRegression(HU_array, material_densities, 'HU-Material Density Slope', 'HU-Material Density Y-Intercept'))
+
+    ic_parameters['Air Density [g/cc]'] = air_den
+    ic_parameters['Cortical Bone Density [g/cc]'] = bone_den
+    ic_parameters['Skeletal Muscle Density [g/cc]'] = muscle_den
+
+    return ic_parameters
+
 def icEffectiveEnergy(HU_array, air, bone, muscle, k2hpo4, cha, triglyceride, water):
     """Used to determine the scan effective energy for internal calibration.
     The first argument is the mean HU for each tissue.
     The remaining arguments are the tissue specific interpolated tables from icInterpolation.
     Returns the scan effective energy and calibration parameters as a dictionary.
     """
-    energy_r2_values = pd.DataFrame(columns = ['Energy [keV]', 'R-Squared'])
-    energy_r2_values['Energy [keV]'] = muscle['Energy [keV]']
+    grid = np.vstack([muscle['Energy [keV]'].to_numpy()] + [
+        table['Mass Attenuation [cm2/g]'].to_numpy()
+        for table in (air, bone, muscle, k2hpo4, cha, triglyceride, water)
+        ])
+    return icEffectiveEnergyGrid(HU_array, grid)
+
+def icEffectiveEnergyGrid(HU_array, grid):
+    """Used to determine the scan effective energy for internal calibration.
+    The first argument is the mean HU for each tissue.
+    The second argument is the interpolated attenuation grid from icAttenuationGrid.
+    Returns the scan effective energy and calibration parameters as a dictionary.
+    """
+    energies = grid[0]
+    attenuation = grid[1:]
 
+    # The first energy of the table is not a candidate effective energy
+    r_squared = icEnergyRSquared(HU_array, attenuation[0:3])
+    r_squared[0] = np.nan
 
-    for i in np.arange(1, len(muscle), 1):
-        attenuation = [
-        air.loc[i,'Mass Attenuation [cm2/g]'],
-        bone.loc[i,'Mass Attenuation [cm2/g]'],
-        muscle.loc[i,'Mass Attenuation [cm2/g]']
-        ]
+    index = int(np.nanargmax(r_squared))
 
-        EE_lr = stats.linregress(HU_array, attenuation)
-        r_squared = EE_lr[2]**2
-        energy_r2_values.loc[i, 'R-Squared'] = r_squared
-
-    max_row = energy_r2_values[energy_r2_values['R-Squared'] == energy_r2_values['R-Squared'].max()]
-    max_r2 = energy_r2_values['R-Squared'].max()
-    index = max_row.index.values.astype(int)[0]
-    effective_energy = max_row.at[index, 'Energy [keV]']
-
-    # Determine the corresponding mass attenuation values for each material
-    air_EE = air.at[index, 'Mass Attenuation [cm2/g]']
-    bone_EE = bone.at[index, 'Mass Attenuation [cm2/g]']
-    muscle_EE = muscle.at[index, 'Mass Attenuation [cm2/g]']
-    k2hpo4_EE = k2hpo4.at[index, 'Mass Attenuation [cm2/g]']
-    cha_EE = cha.at[index, 'Mass Attenuation [cm2/g]']
-    triglyceride_EE = triglyceride.at[index, 'Mass Attenuation [cm2/g]']
-    water_EE = water.at[index, 'Mass Attenuation [cm2/g]']
-
-    # Create dictionary for output
+    # Create dictionary for output, with the mass attenuation values of each
+    # material at the effective energy
     dict = OrderedDict()
-    dict['Effective Energy [keV]'] = effective_energy
-    dict['Max R^2'] = max_r2
-    dict['Air u/p'] = air_EE
-    dict['Cortical Bone u/p'] = bone_EE
-    dict['Skeletal Muscle u/p'] = muscle_EE
-    dict['K2HPO4 u/p'] = k2hpo4_EE
-    dict['CHA u/p'] = cha_EE
-    dict['Triglyceride u/p'] = triglyceride_EE
-    dict['Water u/p'] = water_EE
+    dict['Effective Energy [keV]'] = energies[index]
+    dict['Max R^2'] = r_squared[index]
+    dict['Air u/p'] = attenuation[0, index]
+    dict['Cortical Bone u/p'] = attenuation[1, index]
+    dict['Skeletal Muscle u/p'] = attenuation[2, index]
+    dict['K2HPO4 u/p'] = attenuation[3, index]
+    dict['CHA u/p'] = attenuation[4, index]
+    dict['Triglyceride u/p'] = attenuation[5, index]
+    dict['Water u/p'] = attenuation[6, index]
 
     return dict
 
+def icEnergyRSquared(HU_array, attenuation):
+    """Computes the R^2 of the HU-mass attenuation regression for every candidate energy at once.
+    The first argument is the mean HU for each tissue.
+    The second argument is the mass attenuation array with one row per tissue
+    and one column per energy.
+    Returns the array of R^2 values for each energy.
+    """
+    x = np.asarray(HU_array, dtype=np.float64)
+    y = np.asarray(attenuation, dtype=np.float64)
+    x = x - x.mean()
+    y = y - y.mean(axis=0)
+
+    ssxm = np.dot(x, x)
+    ssym = np.einsum('ij,ij->j', y, y)
+    ssxym = np.dot(x, y)
+
+    # A flat line has no correlation (matches scipy.stats.linregress)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_squared = ssxym * ssxym / (ssxm * ssym)
+    r_squared[(ssxm == 0) | (ssym == 0)] = 0.0
+    return np.minimum(r_squared, 1.0)
+
 def icInterpolation(material_table):
     """Used for internal calibration. Interpolates the material table for energy
-    levels 1-200 keV.The first argument is the reference material table.
+    levels 1-200 keV.The first argument is the reference material table or the
+    material name in MassAttenuationTables.
     Returns the interpolated material table for internal calibration.
     """
-    energies = np.arange(1, 200.5, 0.5)
-    interp_table = interp.griddata(material_table['Energy [keV]'], material_table['Mass Attenuation [cm2/g]'], energies, method = 'linear')
+    if isinstance(material_table, str):
+        energy, attenuation = mat.get(material_table)
+    else:
+        energy = material_table['Energy [keV]']
+        attenuation = material_table['Mass Attenuation [cm2/g]']
+    energies = np.arange(*ic_energy_grid)
+    interp_table = interp.griddata(energy, attenuation, energies, method = 'linear')
     interp_df = pd.DataFrame({'Energy [keV]':energies, 'Mass Attenuation [cm2/g]':interp_table})
     return interp_df
 
@@ -877,6 +1149,23 @@ def icMaterialDensity(material_HU, material_attenuation, water_attenuation, wate
     output_density = (material_HU/1000*water_attenuation*water_density + water_attenuation*water_density)/material_attenuation
     return output_density
 
+def icOutputFiles(image, output_directory=None):
+    """Returns the files written by icCalibrateStudy for an image.
+    The first argument is the image file (NIFTI) or DICOM directory.
+    The second argument is the output directory (defaults to the image directory).
+    Returns the absolute paths of the K2HPO4 and Archimedean calibrated images and
+    of the parameters text file.
+    """
+    image = os.path.abspath(image)
+    if output_directory is None:
+        output_directory = os.path.dirname(image)
+    image_basename = os.path.basename(image)
+    return [
+        os.path.join(os.path.abspath(output_directory), image_basename.replace(".nii", "_IC_K2HPO4.nii")),
+        os.path.join(os.path.abspath(output_directory), image_basename.replace(".nii", "_IC_ARCH.nii")),
+        os.path.join(os.path.abspath(output_directory), image_basename.replace(".nii", "") + "_IntCalibParameters.txt")
+        ]
+
 def Image2Mesh(vtk_image):
     """Mesh image data to hexahedral elements."""
     mesher = vtkbone.vtkboneImageToMesh()
@@ -930,18 +1219,8 @@ def inferiorVertebralPMMA(inferior_model_bounds, spacing, origin, inval, outval,
     iv_pmma_id.AllocateScalars(vtk.VTK_SHORT, 1)
 
     ##
-    # Create numpy array of PMMA cap to convert to vtkImageData
-    iv_pmma_np = np.empty(iv_pmma_id.GetDimensions())
-    iv_pmma_np.fill(inval)
-
-    ##
-    # Import Numpy array to vtk
-    vtk_data = numpy_to_vtk(
-        num_array=iv_pmma_np.ravel(),
-        deep=True,
-        array_type=vtk.VTK_SHORT
-    )
-    iv_pmma_id.GetPointData().SetScalars(vtk_data)
+    # Fill the PMMA cap directly in its scalars
+    flatView(iv_pmma_id).fill(inval)
 
     ##
     # Pad Image with extra thickness
@@ -980,6 +1259,58 @@ def iterativeClosestPoint(source, target):
     icp.Update()
     return icp.GetMatrix()
 
+def labelStatistics(imageData, maskData, labels=None, chunk_size=2**22):
+    """Computes the ROI statistics of every label in a single pass over the image and mask.
+    Unlike maskThreshold, applyMask and imageHistogramMean, voxels with a value of
+    zero inside a label are counted.
+    The first argument is the image. The second argument is the label mask.
+    The third argument is the list of labels to report (defaults to all labels in the mask).
+    The fourth argument is the number of voxels processed at a time.
+    Returns a dictionary with the count, sum, sum of squares, min, max and mean for each label.
+    """
+    image = flatView(imageData)
+    mask = flatView(maskData)
+    if image.size != mask.size:
+        raise ValueError("ERROR: image and mask dimensions do not match")
+
+    n_labels = int(mask.max()) + 1 if mask.size else 1
+    if labels is not None:
+        n_labels = max(n_labels, max(labels) + 1)
+
+    count = np.zeros(n_labels, dtype=np.int64)
+    total = np.zeros(n_labels)
+    total_sq = np.zeros(n_labels)
+    minimum = np.full(n_labels, np.inf)
+    maximum = np.full(n_labels, -np.inf)
+
+    ##
+    # Accumulate each chunk of voxels into the per-label bins
+    for start in range(0, image.size, chunk_size):
+        values = image[start:start+chunk_size].astype(np.float64)
+        ids = mask[start:start+chunk_size].astype(np.intp)
+        count += np.bincount(ids, minlength=n_labels)
+        total += np.bincount(ids, weights=values, minlength=n_labels)
+        total_sq += np.bincount(ids, weights=values*values, minlength=n_labels)
+        np.minimum.at(minimum, ids, values)
+        np.maximum.at(maximum, ids, values)
+
+    if labels is None:
+        labels = np.flatnonzero(count)
+
+    stats = OrderedDict()
+    for label in labels:
+        label = int(label)
+        n = count[label]
+        stats[label] = OrderedDict()
+        stats[label]['count'] = int(n)
+        stats[label]['sum'] = total[label]
+        stats[label]['sum of squares'] = total_sq[label]
+        stats[label]['min'] = minimum[label] if n else np.nan
+        stats[label]['max'] = maximum[label] if n else np.nan
+        stats[label]['mean'] = total[label] / n if n else np.nan
+
+    return stats
+
 def marchingCubes(vtk_image):
     """Performs Marching cubes to get a surface.
     The first argument is the vtk image data.
@@ -1007,7 +1338,7 @@ def maskThreshold(imageData, threshold_value):
     thres.Update()
     return thres.GetOutput()
 
-def materialTable(mesh, poissons_ratio, elastic_Emax, elastic_exponent, pmma_mat_id, pmma_E, pmma_v):
+def materialTable(mesh, poissons_ratio, elastic_Emax, elastic_exponent, pmma_mat_id, pmma_E, pmma_v, law='power', law_parameters=None, den_bin_step=0.001):
     """Defines the material table for the FE model.
     The first argument is the hexahedral mesh.
     The second argument is the bone poissons ratio.
@@ -1016,6 +1347,9 @@ def materialTable(mesh, poissons_ratio, elastic_Emax, elastic_exponent, pmma_mat
     The 5th is the pmma material ID.
     The 6th is the pmma elastic modulus.
     The 7th is the pmma poissons ratio.
+    The 8th is the name of the density-elastic modulus law (see densityModulus).
+    The 9th are the parameters of the law (for the power law, defaults to Emax and exponent).
+    The 10th is the density step between material IDs [g/cc].
     Returns the Finite Element Material Table.
     """
     # Initialize the material table
@@ -1032,28 +1366,19 @@ def materialTable(mesh, poissons_ratio, elastic_Emax, elastic_exponent, pmma_mat
     ##
     # Determine maximum material ID: exclude PMMA
     values = vtk_to_numpy (mesh.GetCellData().GetScalars())
-    max_id = int(max(values))
+    max_id = int(values.max())
     # message("Maximum ID: %d" % max_id)
 
-    # Create array of Young's Modulus values
-    bone_E = np.arange(1, max_id+2, dtype=np.float32)
     # Create array of Poisson's ratio values
-    bone_nu = poissons_ratio * np.ones(max_id+1, dtype=np.float32)
+    bone_nu = np.full(max_id+1, poissons_ratio, dtype=np.float32)
     bone_nu_vtk = numpy_to_vtk(bone_nu, deep=True, array_type=vtk.VTK_FLOAT)
 
     ##
-    # Define the For loop to create the elastic modulus array
+    # Create the elastic modulus array of all material IDs at once. Requires Density in [g/cc], not [mg/cc].
     message("Deriving Density-Elastic Modulus values for material table...")
-    for i in range(1, max_id+1, 1):
-
-        # Power law density-Elastic Modulus conversion. Requires Density in [g/cc], not [mg/cc].
-        den_bin_step = 0.001
-        den = i * den_bin_step
-        # message("Calculated density: %8.4f" % den)
-        modulus = elastic_Emax * math.pow(den, elastic_exponent)
-        # message("Calculated Elastic Modulus: %8.4f" % modulus)
-        bone_E[i] = modulus
-        # message("ID:%d; Density(g/cc):%8.4f; Modulus(MPa):%8.4f" % (i, den, modulus))
+    if law_parameters is None and law == 'power':
+        law_parameters = (elastic_Emax, elastic_exponent)
+    bone_E = densityModulus(max_id, law, law_parameters, den_bin_step)
 
     # Convert these numpy arrays to VTK arrays
     bone_E_vtk = numpy_to_vtk(bone_E, deep=True, array_type=vtk.VTK_FLOAT)
@@ -1077,23 +1402,40 @@ def message(msg, *additionalLines):
     for line in additionalLines:
         print(" " * 9 + line)
 
+def newestNifti(directory, exclude=()):
+    """Finds the most recently modified NIFTI file in a directory, e.g. the mask
+    just saved from ITK-SNAP. Hidden files and calibrated output images are skipped.
+    The first argument is the directory.
+    The second argument is a list of files to skip as well (e.g. the image itself).
+    Returns the path of the file, None if there is no NIFTI file.
+    """
+    exclude = set(os.path.abspath(f) for f in exclude)
+    newest = None
+    newest_mtime = None
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith('.') or not name.endswith('.nii'):
+                continue
+            if name.endswith('_IC_K2HPO4.nii') or name.endswith('_IC_ARCH.nii'):
+                continue
+            if os.path.abspath(entry.path) in exclude or not entry.is_file():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            if newest_mtime is None or mtime > newest_mtime:
+                newest, newest_mtime = entry.path, mtime
+    return newest
+
 def numpy2vtk(numpy_image, extent, spacing, origin):
     """Convert numpy image to vtk Image Data.
-    The first argument is the numpy image.
+    The first argument is the numpy image indexed [x, y, z] (e.g. from vtk2numpy).
     The second argument is the image extent.
     The third argument is the image spacing.
-    Returns the vtk Image Data in the same shape as FLOAT data type.
-    """
-    dimensions = numpy_image.shape
-    vtk_image = vtk.vtkImageImport()
-    vtk_image.SetDataScalarTypeToFloat()
-    vtk_image.SetNumberOfScalarComponents(1)
-    vtk_image.SetDataExtent(0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1)
-    vtk_image.SetWholeExtent(extent)
-    vtk_image.SetDataSpacing(spacing)
-    vtk_image.SetDataOrigin(origin)
-    vtk_image.CopyImportVoidPointer(numpy_image, numpy_image.nbytes)
-    return vtk_image.GetOutput()
+    The fourth argument is the image origin.
+    Returns the vtk Image Data in the same shape as FLOAT data type. A float32
+    image from vtk2numpy is wrapped without copying.
+    """
+    return numpyToImage(numpy_image.astype(np.float32, copy=False), spacing, origin, extent)
 
 def phantomParameters(h2o_density, k2hpo4_density, phantom_HU):
     """Determine the slope and y-intercept for the phantom calibration.
@@ -1139,6 +1481,22 @@ def phantomParameters_bmas200(cha_density, phantom_HU):
     'Calibration Y-Intercept':calibration_yint
     }
 
+def piecewisePowerLaw(density, segments):
+    """Piecewise density-elastic modulus power law.
+    The first argument is the density array [g/cc].
+    The second argument is a list of (start density, Emax, exponent) segments.
+    A segment applies from its start density up to the start of the next
+    segment; the first segment also applies below its start density.
+    Returns the elastic modulus array [MPa].
+    """
+    segments = sorted(segments)
+    starts = np.array([segment[0] for segment in segments], dtype=np.float64)
+    Emax = np.array([segment[1] for segment in segments], dtype=np.float64)
+    exponent = np.array([segment[2] for segment in segments], dtype=np.float64)
+
+    index = np.maximum(np.searchsorted(starts, density, side='right') - 1, 0)
+    return Emax[index] * np.power(density, exponent[index])
+
 def point2cellData(vtk_image):
     """ Converts vtk image point data to cell data.
     The first argument is the vtk image.
@@ -1150,12 +1508,28 @@ def point2cellData(vtk_image):
     pt2cell.Update()
     return pt2cell.GetOutput()
 
+def powerLaw(density, Emax, exponent):
+    """Density-elastic modulus power law, E = Emax * density^exponent.
+    The first argument is the density array [g/cc].
+    The second argument is Emax [MPa].
+    The third argument is the exponent.
+    Returns the elastic modulus array [MPa].
+    """
+    return Emax * np.power(density, exponent)
+
 def preRotateImage(image, mask, z_rotation):
     """Pre-rotation the image for ICP alignment."""
     message("Pre-rotating image...")
-    spacing = image.GetSpacing()
-    origin = image.GetOrigin()
-    extent = image.GetExtent()
+    transform = preRotationTransform(image, z_rotation)
+    return transformImages(image, mask, transform, auto_crop=False)
+
+def preRotationTransform(image, z_rotation):
+    """Builds the pre-rotation for ICP alignment: 180 degrees about y and
+    z_rotation degrees about z, around the centre of the image.
+    The first argument is the vtk image data.
+    The second argument is the rotation about z in degrees.
+    Returns the vtkTransform.
+    """
     bounds = image.GetBounds()
     center = [None]*3
     center[0] = (bounds[1] + bounds[0])/2.0
@@ -1167,24 +1541,78 @@ def preRotateImage(image, mask, z_rotation):
     transform.RotateY(180)
     transform.RotateZ(z_rotation)
     transform.Translate(-center[0], -center[1], -center[2])
+    transform.Update()
+    return transform
 
-    image_reslice = vtk.vtkImageReslice()
-    image_reslice.SetResliceTransform(transform)
-    image_reslice.SetInterpolationModeToCubic()
-    # image_reslice.AutoCropOutputOn()
-    image_reslice.SetInputData(image)
-    image_reslice.Update()
 
-    # Apply transform to image and reslice
-    mask_reslice = vtk.vtkImageReslice()
-    mask_reslice.SetResliceTransform(transform)
-    mask_reslice.SetInterpolationModeToNearestNeighbor()
-    # image_reslice.AutoCropOutputOn()
-    mask_reslice.SetInputData(mask)
-    mask_reslice.Update()
+def probe(path):
+    """Reads only the header of an image: a NIFTI header, or the header of a
+    single slice of a DICOM directory.
+    The first argument is the image file or DICOM directory.
+    Returns a dictionary of the format, shape, spacing, dtype, qform (4x4
+    voxel to RAS mm matrix) and the estimated memory of the image in bytes. The
+    number of slices of a DICOM directory is estimated from its file count.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError("ERROR: image not found " + path)
 
-    return image_reslice.GetOutput(), mask_reslice.GetOutput()
+    info = OrderedDict()
 
+    if path.endswith('.nii') and not os.path.isdir(path):
+        nifti = MappedNifti(path)
+        info['format'] = 'NIFTI'
+        info['shape'] = nifti.dimensions
+        info['spacing'] = nifti.spacing
+        info['dtype'] = nifti.data.dtype.newbyteorder('=')
+        info['qform'] = nifti.qform() if nifti.header['qform_code'] > 0 else nifti.affine()
+        del nifti
+
+    else:
+        reader = sitk.ImageFileReader()
+        slices = 1
+        if os.path.isdir(path):
+            names = sorted(
+                entry.path for entry in os.scandir(path)
+                if entry.is_file() and not entry.name.startswith('.')
+                and not entry.name.endswith(('.nii', '.nii.gz', '.txt', '.json'))
+            )
+            if not names:
+                raise ValueError("ERROR: no DICOM files in " + path)
+            reader.SetImageIO('GDCMImageIO')
+            reader.SetFileName(names[0])
+            slices = len(names)
+            info['format'] = 'DICOM'
+        else:
+            reader.SetFileName(path)
+        try:
+            reader.ReadImageInformation()
+        except RuntimeError as e:
+            raise ValueError("ERROR: cannot read the header of " + path + ": " + str(e))
+        if 'format' not in info:
+            info['format'] = 'NIFTI' if path.endswith('.nii.gz') else os.path.splitext(path)[1].lstrip('.').upper()
+
+        size = list(reader.GetSize()) + [1]*(3 - reader.GetDimension())
+        spacing = list(reader.GetSpacing()) + [1.0]*(3 - reader.GetDimension())
+        if slices > 1:
+            size[2] = slices
+            for key in ('0018|0088', '0018|0050'): # spacing between slices, slice thickness
+                if reader.HasMetaDataKey(key) and reader.GetMetaData(key).strip():
+                    spacing[2] = float(reader.GetMetaData(key))
+                    break
+        info['shape'] = tuple(size)
+        info['spacing'] = tuple(spacing)
+        info['dtype'] = np.dtype(sitk.GetArrayViewFromImage(sitk.Image([1]*reader.GetDimension(), reader.GetPixelID())).dtype)
+
+        # ITK gives the geometry in LPS, the qform is in RAS
+        direction = np.reshape(reader.GetDirection(), (reader.GetDimension(),)*2)
+        qform = np.eye(4)
+        qform[:reader.GetDimension(), :reader.GetDimension()] = direction * spacing[:reader.GetDimension()]
+        qform[:reader.GetDimension(), 3] = reader.GetOrigin()
+        info['qform'] = np.diag([-1.0, -1.0, 1.0, 1.0]) @ qform
+
+    info['bytes'] = int(np.prod(info['shape'], dtype=np.int64)) * info['dtype'].itemsize
+
+    return info
 
 def readDCM(fileDir):
     """Reads a DICOM image from a directory.
@@ -1206,11 +1634,62 @@ def readDCM(fileDir):
 
     return flip2.GetOutput()
 
-def readNii(filename):
+def readDicomFiles(file_names):
+    """Reads a DICOM image from a list of slice files.
+    vtkDICOMImageReader only reads whole directories, so the slices are linked
+    into a temporary directory that is removed after reading.
+    The first argument is the list of slice files.
+    Returns the image as vtk Output Data.
+    """
+    link_dir = tempfile.mkdtemp(prefix='ogo_dicom_')
+    try:
+        for i, fnm in enumerate(file_names):
+            link = os.path.join(link_dir, '%06d.dcm' % i)
+            try:
+                os.symlink(os.path.abspath(fnm), link)
+            except (OSError, NotImplementedError):
+                try:
+                    os.link(fnm, link)
+                except OSError:
+                    shutil.copyfile(fnm, link)
+
+        image = vtk.vtkDICOMImageReader()
+        image.SetDirectoryName(link_dir)
+        image.Update()
+        return image.GetOutput()
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+def readImage(filename, mmap=False):
+    """Reads a NIFTI image or DICOM directory with the correct reader.
+    The first argument is the image filename or DICOM directory.
+    The second argument memory-maps uncompressed NIFTI files (see readNii).
+    Returns the Image as vtk Output Data.
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError("ERROR: image not found " + filename)
+
+    if (os.path.isdir(filename)):
+        message("Input is DICOM")
+        return readDCM(filename)
+
+    ext = os.path.splitext(filename)[1]
+    if (ext == ".nii" or ext == ".nifti"):
+        message("Input is NIFTI")
+        return readNii(filename, mmap)
+
+    raise ValueError("ERROR: image format not recognized for " + filename)
+
+def readNii(filename, mmap=False):
     """Reads a NIFTI image.
     The first argument is the image filename.
+    The second argument memory-maps an uncompressed .nii file instead of reading
+    it (see nifti_mmap); the file must not be overwritten while the image is used.
     Returns the Image as vtk Output Data
     """
+    if mmap and filename.endswith('.nii'):
+        return MappedNifti(filename).toVTK()
+
     image = vtk.vtkNIFTIImageReader()
     image.SetFileName(filename)
     image.Update()
@@ -1263,10 +1742,178 @@ def readTransform(transform_file):
 
     return m
 
+def registerImages(fixed_image, moving_mask, moving_image=None, number_of_threads=None, sampling_percentage=0.01, use_cache=False, cache_dir=None):
+    """Registers a mask to a reference image and resamples the mask and an image
+    with the final transform, all in memory.
+    The first argument is the reference (fixed) SimpleITK image.
+    The second argument is the mask (moving) SimpleITK image, used for registration.
+    The third argument is the SimpleITK image to transform with the mask (optional).
+    The remaining arguments are passed to registrationTransform.
+    Returns the resampled mask (thresholded to 0 and 1), the resampled image
+    (None without an image) and the final transform.
+    """
+    final_transform = registrationTransform(
+        fixed_image, moving_mask,
+        number_of_threads=number_of_threads,
+        sampling_percentage=sampling_percentage,
+        use_cache=use_cache,
+        cache_dir=cache_dir
+        )
+
+    message("Resampling the images...")
+    resample = sitk.ResampleImageFilter()
+    resample.SetReferenceImage(fixed_image)
+    resample.SetTransform(final_transform)
+    resample.SetDefaultPixelValue(0.0)
+    if number_of_threads:
+        resample.SetNumberOfThreads(number_of_threads)
+
+    resample.SetInterpolator(sitk.sitkLinear)
+    resample.SetOutputPixelType(moving_mask.GetPixelID())
+    moving_resampled = resample.Execute(moving_mask)
+    moving_thres = sitk.BinaryThreshold(moving_resampled,
+        lowerThreshold=0.01,
+        insideValue=1,
+        outsideValue=0
+        )
+
+    org_trans = None
+    if moving_image is not None:
+        resample.SetInterpolator(sitk.sitkBSpline)
+        resample.SetOutputPixelType(moving_image.GetPixelID())
+        org_trans = resample.Execute(moving_image)
+
+    return moving_thres, org_trans, final_transform
+
+def registrationTransform(fixed_image, moving_image, number_of_threads=None, sampling_percentage=0.01, use_cache=False, cache_dir=None):
+    """Finds the rigid transform registering a moving image to a fixed image
+    (moments initialization, then joint histogram mutual information with
+    random sampling over three resolution levels).
+    The first argument is the fixed SimpleITK image.
+    The second argument is the moving SimpleITK image.
+    The third argument is the number of threads (defaults to all cores).
+    The fourth argument is the fraction of voxels sampled for the metric.
+    The fifth argument reuses the transform found earlier (also by an earlier
+    run) for the same images and sampling percentage, skipping the optimizer.
+    The transforms are stored as .tfm files in the cache directory.
+    The sixth argument is the cache directory (defaults to $OGO_CACHE_DIR or ~/.cache/ogo).
+    Returns the final transform.
+    """
+    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+
+    fileName = None
+    if use_cache:
+        key = hashlib.sha1(repr((_sitkImageKey(fixed_image), _sitkImageKey(moving_image), sampling_percentage)).encode())
+        fileName = os.path.join(_cacheDirectory(cache_dir), 'registration_%s.tfm' % key.hexdigest()[:16])
+        if fileName not in _registration_cache and os.path.exists(fileName):
+            try:
+                _registration_cache[fileName] = sitk.ReadTransform(fileName)
+            except RuntimeError as e:
+                message("WARNING: could not read the cached registration transform", str(e))
+        if fileName in _registration_cache:
+            message("Using the cached registration transform: %s" % fileName)
+            return sitk.Transform(_registration_cache[fileName])
+
+    message("Performing initial registration transform...")
+    initial_transform = sitk.CenteredTransformInitializer(fixed_image,
+                                                      moving_image,
+                                                      sitk.Euler3DTransform(),
+                                                      sitk.CenteredTransformInitializerFilter.MOMENTS
+                                                      )
+
+    message("Setting up registration parameters...")
+    registration_method = sitk.ImageRegistrationMethod()
+    if number_of_threads:
+        registration_method.SetNumberOfThreads(number_of_threads)
+    registration_method.SetMetricAsJointHistogramMutualInformation(
+        numberOfHistogramBins=100
+        )
+    registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
+    registration_method.SetMetricSamplingPercentage(sampling_percentage)
+    registration_method.SetInterpolator(sitk.sitkLinear)
+    registration_method.SetOptimizerAsGradientDescent(
+        learningRate=1.0,
+        numberOfIterations=100,
+        convergenceMinimumValue=1e-6,
+        convergenceWindowSize=10
+        )
+    registration_method.SetOptimizerScalesFromPhysicalShift()
+    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
+    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
+    registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+    registration_method.SetInitialTransform(initial_transform,
+        inPlace=False
+        )
+
+    message("Executing the registration...")
+    final_transform = registration_method.Execute(fixed_image, moving_image)
+    message("Registration complete...")
+
+    print(('Final metric value: {0}'.format(registration_method.GetMetricValue())))
+    print(('Optimizer\'s stopping condition, {0}'.format(
+    registration_method.GetOptimizerStopConditionDescription())))
+
+    if fileName is not None:
+        _registration_cache[fileName] = sitk.Transform(final_transform)
+
+        # Write to a temporary file first so concurrent runs never read a partial transform
+        try:
+            os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            fd, tmp_fileName = tempfile.mkstemp(suffix='.tfm', dir=os.path.dirname(fileName))
+            os.close(fd)
+            sitk.WriteTransform(final_transform, tmp_fileName)
+            os.replace(tmp_fileName, fileName)
+        except (OSError, RuntimeError) as e:
+            message("WARNING: could not write the registration transform cache", str(e))
+
+    return final_transform
+
+def resliceImage(vtk_image, transform, interpolation='cubic', auto_crop=True, number_of_threads=None):
+    """Resamples an image with a transform in one multi-threaded reslice.
+    The first argument is the vtk image data.
+    The second argument is the reslice transform (vtkMatrix4x4 or
+    vtkLinearTransform, e.g. from composeTransforms).
+    The third argument is the interpolation ('cubic', 'linear' or 'nearest').
+    The fourth argument grows the output to hold the whole transformed image,
+    otherwise the output has the grid of the input.
+    The fifth argument is the number of threads (defaults to all cores).
+    Returns the resliced image.
+    """
+    if isinstance(transform, vtk.vtkMatrix4x4):
+        transform = composeTransforms(transform)
+
+    reslice = vtk.vtkImageReslice()
+    reslice.SetInputData(vtk_image)
+    if interpolation == 'cubic':
+        reslice.SetInterpolationModeToCubic()
+    elif interpolation == 'linear':
+        reslice.SetInterpolationModeToLinear()
+    elif interpolation == 'nearest':
+        reslice.SetInterpolationModeToNearestNeighbor()
+    else:
+        raise ValueError("ERROR: unknown interpolation '%s'" % interpolation)
+    reslice.SetResliceTransform(transform)
+    reslice.SetAutoCropOutput(auto_crop)
+    reslice.SetNumberOfThreads(number_of_threads or os.cpu_count() or 1)
+    reslice.Update()
+
+    return reslice.GetOutput()
+
 def sitk2numpy(sitk_image):
     numpy_image = sitk.GetArrayFromImage(sitk_image)
     return numpy_image
 
+def sitk2vtk(sitk_image):
+    """Converts a SimpleITK image to vtk image data with the same origin and
+    spacing (the direction is not kept).
+    The first argument is the SimpleITK image.
+    Returns the vtk image data.
+    """
+    array = sitk.GetArrayFromImage(sitk_image)
+    # the [z, y, x] array from SimpleITK transposes to [x, y, z] without a copy
+    return numpyToImage(array.T, sitk_image.GetSpacing(), sitk_image.GetOrigin())
+
 def superiorVertebralPMMA(superior_model_bounds, spacing, origin, inval, outval, thickness, pmma_mat_id):
     """Creates the image data for the superior vertebral PMMA cap.
     The arguments are the superior vertebral  model bounds, image spacing, image origin, in value of pmma, out value for pmma, pmma thickness and pmma material ID.
@@ -1288,18 +1935,8 @@ def superiorVertebralPMMA(superior_model_bounds, spacing, origin, inval, outval,
     sv_pmma_id.AllocateScalars(vtk.VTK_SHORT, 1)
 
     ##
-    # Create numpy array of PMMA cap to convert to vtkImageData
-    sv_pmma_np = np.empty(sv_pmma_id.GetDimensions())
-    sv_pmma_np.fill(inval)
-
-    ##
-    # Import Numpy array to vtk
-    vtk_data = numpy_to_vtk(
-        num_array=sv_pmma_np.ravel(),
-        deep=True,
-        array_type=vtk.VTK_SHORT
-    )
-    sv_pmma_id.GetPointData().SetScalars(vtk_data)
+    # Fill the PMMA cap directly in its scalars
+    flatView(sv_pmma_id).fill(inval)
 
     ##
     # Pad Image with extra thickness
@@ -1320,6 +1957,34 @@ def superiorVertebralPMMA(superior_model_bounds, spacing, origin, inval, outval,
 
     return sv_pmma_id_pad.GetOutput()
 
+def transformImages(image, mask, transform, auto_crop=True, number_of_threads=None):
+    """Resamples an image (cubic) and its mask (nearest neighbour) once each
+    with the same transform, onto the same output grid.
+    The first argument is the vtk image data.
+    The second argument is the vtk mask image data.
+    The third argument is the reslice transform (see composeTransforms).
+    The remaining arguments are passed to resliceImage.
+    Returns the transformed image and mask.
+    """
+    transformed_image = resliceImage(image, transform, 'cubic', auto_crop, number_of_threads)
+    transformed_mask = resliceImage(mask, transform, 'nearest', auto_crop, number_of_threads)
+    return transformed_image, transformed_mask
+
+def validateMask(image, mask):
+    """Checks from the file headers only (see probe) that a mask matches the image grid.
+    The first argument is the image file or DICOM directory.
+    The second argument is the mask file or DICOM directory.
+    Raises ValueError if the size or spacing of the mask differs from the image.
+    Returns the probe of the image.
+    """
+    image_info = probe(image)
+    mask_info = probe(mask)
+    if image_info['shape'] != mask_info['shape']:
+        raise ValueError("ERROR: mask size %s does not match image size %s" % (mask_info['shape'], image_info['shape']))
+    if not np.allclose(image_info['spacing'], mask_info['spacing'], rtol=1e-3):
+        raise ValueError("ERROR: mask spacing %s does not match image spacing %s" % (mask_info['spacing'], image_info['spacing']))
+    return image_info
+
 def vertebralBodyExtract(image, mask_image):
     """Extracts the body of the vertebra from the whole vertebra for FE.
     The first argument is the vertebra mask.
@@ -1346,24 +2011,21 @@ def vertebralBodyExtract(image, mask_image):
     extract.IncludeBoundaryOn()
     extract.Update()
 
+    ##
+    # Same results as vtkImageContinuousErode3D/Dilate3D with these kernels, from
+    # distance transforms whose cost does not grow with the kernel size
     message("Eroding the body mask...")
-    erode = vtk.vtkImageContinuousErode3D()
-    erode.SetInputData(extract.GetOutput())
-    erode.SetKernelSize(21,21,21)
-    erode.Update()
+    eroded = morphology.erodeImage(extract.GetOutput(), (21,21,21))
 
     message("Extracting Largest connected component...")
-    conn = imageConnectivity(erode.GetOutput())
+    conn = imageConnectivity(eroded)
 
     message("Dilating the body mask...")
-    dilate = vtk.vtkImageContinuousDilate3D()
-    dilate.SetInputData(conn)
-    dilate.SetKernelSize(50,25,50)
-    dilate.Update()
+    dilated = morphology.dilateImage(conn, (50,25,50))
 
     message("Boolean of vertebra and dialtion masks...")
     logic = vtk.vtkImageLogic()
-    logic.SetInput1Data(dilate.GetOutput())
+    logic.SetInput1Data(dilated)
     logic.SetInput2Data(mask_image)
     logic.SetOperationToAnd()
     logic.SetOutputTrueValue(1)
@@ -1392,14 +2054,26 @@ def vertebralBodyExtract(image, mask_image):
 
     return image, final_body_mask
 
+def vtk2sitk(vtk_image):
+    """Converts vtk image data to a SimpleITK image with the same origin and
+    spacing (and an identity direction).
+    The first argument is the vtk image data.
+    Returns the SimpleITK image.
+    """
+    sitk_image = sitk.GetImageFromArray(imageView(vtk_image).T)
+    spacing = vtk_image.GetSpacing()
+    # the first voxel of the extent is the origin of the SimpleITK image
+    origin = [o + e*sp for o, e, sp in zip(vtk_image.GetOrigin(), vtk_image.GetExtent()[0::2], spacing)]
+    sitk_image.SetSpacing(spacing)
+    sitk_image.SetOrigin(origin)
+    return sitk_image
+
 def vtk2numpy(vtk_image):
     """Convert vtk image data to a numpy array in same shape.
     The first argument is the vtk image data.
-    Returns the numpy array.
+    Returns the numpy array indexed [x, y, z], a view sharing the memory of the image.
     """
-    numpy_image = vtk_to_numpy(vtk_image.GetPointData().GetScalars())
-    numpy_image.shape = vtk_image.GetDimensions()
-    return numpy_image
+    return imageView(vtk_image)
 
 def writeN88Model(model, fileName, pathname):
     """Writes out a N88Model.
@@ -1438,105 +2112,237 @@ def writeTXTfile(input_dict, fileName, output_directory):
         txt_file.write(str(key) + '\t' + str(value) + '\n')
     txt_file.close()
 
-def remove_ScoutView(filePath):
-    series_IDs = sitk.ImageSeriesReader.GetGDCMSeriesIDs(filePath)
-    series_file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(filePath, series_IDs[0])
-    is_file = os.path.exists(filePath+'/scout_image_file')
-    if is_file == False:
-        os.mkdir(filePath+'/scout_image_file')
-
-    for fnm in series_file_names:
-        reader = sitk.ImageFileReader()
-        reader.SetFileName(fnm)
-        reader.LoadPrivateTagsOn()
+def _readDicomHeader(fileName):
+    """Reads the series UID, instance number and patient orientation of a DICOM slice.
+    Returns None if the file is not a DICOM image.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(fileName)
+    try:
         reader.ReadImageInformation()
-        instance_num = reader.GetMetaData('0020|0013') #0020,0013 is the dicom tag for instance number
-        pt_orientation = reader.GetMetaData('0020|0037').split('\\') #0020|0037 is the dicom tag for patient orientation
-        #for these coronal scans, patient orientation should be: "1.000000\0.000000\0.000000\0.000000\0.000000\-1.000000"
-        #if it is "0.000000\1.000000\0.000000\0.000000\0.000000\-1.000000", then it is the sagittal scoutview.
-        if  float(pt_orientation[0]) < 0.5:
-            shutil.move(fnm,filePath+'/scout_image_file')
-
-    # print(instance_num_max)
-
-    # for fnm in series_file_names:
-    #     reader = sitk.ImageFileReader()
-    #     reader.SetFileName(fnm)
-    #     reader.LoadPrivateTagsOn()
-    #     reader.ReadImageInformation()
-    #     instance_num = reader.GetMetaData('0020|0013') #0020,0013 is the dicom tag for instance number
-    #     if instance_num < instance_num_max:
-    #         # os.mkdir(filePath+'/scout_image_files')
-    #         shutil.move(fnm,filePath+'/scout_image_files')
-
-
-
-def dicom2nifti(filePath, outputImage,orientation_mat):
-    # dicomReader = vtk.vtkDICOMImageReader()
-    # dicomReader.SetDirectoryName(filePath)
-    # dicomReader.Update()
-    # dicomImage = dicomReader.GetOutput()
-
-    remove_ScoutView(filePath)
-
-
-    dicomReader = vtk.vtkDICOMImageReader()
-    dicomReader.SetDirectoryName(filePath)
-    dicomReader.Update()
-    dicomImage = dicomReader.GetOutput()
-    pt_orientation = dicomReader.GetImageOrientationPatient()
-
-
-
-    #Flip image so that it's in the correct anatomical orientation (not upside down):
-    # flip = vtk.vtkImageFlip()
-    # flip.SetInputConnection(dicomReader.GetOutputPort())
-    # flip.SetFilteredAxis(1)
-    # flip.Update()
-    # img_flip1 =  flip.GetOutput()
-    # flip2 = vtk.vtkImageFlip()
-    # flip2.SetInputConnection(flip.GetOutputPort())
-    # flip2.SetFilteredAxis(0)
-    # flip2.Update()
-    #
-    # img_flip2 =  flip2.GetOutput()
-    #
-    # mhaWriter = vtk.vtkNIFTIImageWriter()
-    # # mhaWriter.SetDirectoryName(filePath)
-    # mhaWriter.SetFileName(filePath+'/'+outputImage+'_flip1.nii')
-    # mhaWriter.SetInputData(img_flip1)
-    # mhaWriter.Write()
+    except RuntimeError:
+        return None
+
+    def tag(key, default=''):
+        return reader.GetMetaData(key).strip() if reader.HasMetaDataKey(key) else default
+
+    instance_num = tag('0020|0013', '0') #0020,0013 is the dicom tag for instance number
+    pt_orientation = tag('0020|0037', '1\\0\\0\\0\\0\\-1').split('\\') #0020|0037 is the dicom tag for patient orientation
+    return tag('0020|000e'), int(float(instance_num or 0)), [float(x) for x in pt_orientation]
+
+def remove_ScoutView(filePath, max_workers=None):
+    """Finds the slices of the DICOM series in the directory that are not part of the scout view.
+    The slice headers are read in a thread pool and the files are left in place.
+    The first argument is the DICOM directory.
+    The second argument is the number of threads reading headers.
+    Returns the list of slice file names sorted by instance number.
+    """
+    return scanDicomSeries(filePath, max_workers)[1]
+
+def scanDicomSeries(filePath, max_workers=None):
+    """Reads the slice headers of the DICOM directory in a thread pool and
+    selects the slices of the series that are not part of the scout view.
+    The first argument is the DICOM directory.
+    The second argument is the number of threads reading headers.
+    Returns the SeriesInstanceUID and the list of slice file names sorted by instance number.
+    """
+    file_names = sorted(
+        entry.path for entry in os.scandir(filePath)
+        if entry.is_file() and not entry.name.startswith('.')
+        )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = list(executor.map(_readDicomHeader, file_names))
+
+    slices = [(header, fnm) for header, fnm in zip(headers, file_names) if header is not None]
+    if not slices:
+        raise ValueError("ERROR: no DICOM images found in " + filePath)
+    series_ID = sorted(set(header[0] for header, fnm in slices))[0]
+
+    #for these coronal scans, patient orientation should be: "1.000000\0.000000\0.000000\0.000000\0.000000\-1.000000"
+    #if it is "0.000000\1.000000\0.000000\0.000000\0.000000\-1.000000", then it is the sagittal scoutview.
+    series_file_names = [
+        (instance_num, fnm) for (series, instance_num, pt_orientation), fnm in slices
+        if series == series_ID and pt_orientation[0] >= 0.5
+        ]
+    return series_ID, [fnm for instance_num, fnm in sorted(series_file_names)]
+
+def _dicomListingKey(filePath):
+    """Digest of the names, sizes and modification times of the files in a DICOM
+    directory, leaving out the NIFTI, text and cache files written next to the slices.
+    """
+    key = hashlib.sha1()
+    for entry in sorted(os.scandir(filePath), key=lambda e: e.name):
+        if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith(('.nii', '.nii.gz', '.txt', '.json')):
+            continue
+        stat = entry.stat()
+        key.update(('%s\t%d\t%d\n' % (entry.name, stat.st_size, stat.st_mtime_ns)).encode())
+    return key.hexdigest()
+
+def dicom2niftiCacheStats():
+    """Returns the dicom2nifti cache hits, misses and hit rate of this process."""
+    stats = OrderedDict(_dicom2nifti_cache)
+    total = stats['hits'] + stats['misses']
+    stats['hit rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
+def dicom2image(filePath, outputImage, orientation_mat, use_cache=True, background=True):
+    """Reads the DICOM series in a directory (without the scout view) into memory
+    and writes its NIFTI conversion in a background thread, so the image can be
+    used while it is being written (see dicom2nifti for the conversion cache).
+    The first argument is the DICOM directory, where the NIFTI file is written.
+    The second argument is the output file name without extension.
+    The third argument is the qform matrix.
+    The fourth argument enables the conversion cache.
+    The fifth argument writes the NIFTI file in the background (else before returning).
+    Returns the image, as readNii reads the NIFTI file, and a Future of the NIFTI
+    file name that is done once the file is written.
+    """
+    nii_fileName, conversion = _dicom2niftiPlan(filePath, outputImage, orientation_mat, use_cache)
+    written = concurrent.futures.Future()
+    if conversion is None:
+        written.set_result(nii_fileName)
+        return readNii(nii_fileName), written
+
+    _dicom2nifti_cache['misses'] += 1
+    message("Reading DICOM: %s" % filePath)
+    dicomImage = readDicomFiles(conversion['files'])
+
+    # The NIFTI reader puts the origin at zero (the qform holds the position),
+    # the file stores the spacing in single precision and a zero spacing reads as 1.
+    # The copy is made before the writer is started, since the writer thread runs
+    # a VTK pipeline on the DICOM image.
+    imageData = vtk.vtkImageData()
+    imageData.ShallowCopy(dicomImage)
+    imageData.SetOrigin(0, 0, 0)
+    imageData.SetSpacing([float(np.float32(s)) or 1.0 for s in dicomImage.GetSpacing()])
+
+    if background:
+        written = _backgroundWriter().submit(_dicom2niftiWrite, dicomImage, nii_fileName, orientation_mat, conversion)
+    else:
+        written.set_result(_dicom2niftiWrite(dicomImage, nii_fileName, orientation_mat, conversion))
+
+    return imageData, written
+
+def dicom2nifti(filePath, outputImage,orientation_mat, use_cache=True):
+    """Converts the DICOM series in a directory (without the scout view) to NIFTI.
+    The conversion is skipped when the NIFTI file was already written for the same
+    series, slice files (names, sizes and modification times) and qform matrix.
+    The first argument is the DICOM directory, where the NIFTI file is written.
+    The second argument is the output file name without extension.
+    The third argument is the qform matrix.
+    The fourth argument enables the conversion cache.
+    Returns the NIFTI file name.
+    """
+    nii_fileName, conversion = _dicom2niftiPlan(filePath, outputImage, orientation_mat, use_cache)
+    if conversion is None:
+        return nii_fileName
+
+    _dicom2nifti_cache['misses'] += 1
+    message("Converting DICOM to NIFTI: %s" % nii_fileName)
+    dicomImage = readDicomFiles(conversion['files'])
+    return _dicom2niftiWrite(dicomImage, nii_fileName, orientation_mat, conversion)
+
+def _cacheDirectory(cache_dir=None):
+    """Returns the cache directory ($OGO_CACHE_DIR or ~/.cache/ogo unless given)."""
+    if cache_dir is None:
+        cache_dir = os.environ.get('OGO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ogo'))
+    return cache_dir
+
+def _sitkImageKey(sitk_image):
+    """Returns a key identifying the voxels and geometry of a SimpleITK image."""
+    return (sitk.Hash(sitk_image), sitk_image.GetSize(), sitk_image.GetSpacing(),
+        sitk_image.GetOrigin(), sitk_image.GetDirection())
+
+def _backgroundWriter():
+    """Returns the single thread used for background NIFTI writes. Its pending
+    writes are finished before the interpreter exits."""
+    global _background_writer
+    if _background_writer is None:
+        _background_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ogo_writer')
+    return _background_writer
+
+def _dicom2niftiPlan(filePath, outputImage, orientation_mat, use_cache):
+    """Checks the dicom2nifti cache.
+    Returns the NIFTI file name and None when the cached file is valid, else
+    the NIFTI file name and the series to convert (slice files and cache keys).
+    """
+    nii_fileName = filePath+'/'+outputImage+'.nii'
+    cache_fileName = filePath+'/.'+outputImage+'.dicom2nifti.json'
+    qform = [orientation_mat.GetElement(i, j) for i in range(4) for j in range(4)]
 
+    ##
+    # Check the cache: first on the directory listing alone, then on the series
+    # and slice files (so that unrelated new files do not force a conversion)
+    cache = {}
+    if use_cache and os.path.exists(cache_fileName) and os.path.exists(nii_fileName):
+        try:
+            with open(cache_fileName, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        if cache.get('nii') != _fileStamp(nii_fileName) or cache.get('qform') != qform:
+            cache = {}
+
+    listing_key = _dicomListingKey(filePath)
+    if cache and cache.get('listing') == listing_key:
+        return _dicom2niftiCacheHit(nii_fileName), None
+
+    series_ID, file_names = scanDicomSeries(filePath)
+    series_key = hashlib.sha1(series_ID.encode())
+    for fnm in file_names:
+        stat = os.stat(fnm)
+        series_key.update(('%s\t%d\t%d\n' % (os.path.basename(fnm), stat.st_size, stat.st_mtime_ns)).encode())
+    series_key = series_key.hexdigest()
+    if cache and cache.get('series') == series_key:
+        cache['listing'] = listing_key
+        _writeJSON(cache, cache_fileName)
+        return _dicom2niftiCacheHit(nii_fileName), None
+
+    return nii_fileName, OrderedDict([
+        ('files', file_names),
+        ('SeriesInstanceUID', series_ID),
+        ('series', series_key),
+        ('listing', listing_key),
+        ('qform', qform),
+        ('cache', cache_fileName if use_cache else None)
+        ])
+
+def _dicom2niftiWrite(dicomImage, nii_fileName, orientation_mat, conversion):
+    """Writes the NIFTI conversion of a DICOM series and its cache entry.
+    Returns the NIFTI file name.
+    """
     niiWriter = vtk.vtkNIFTIImageWriter()
-    niiWriter.SetFileName(filePath+'/'+outputImage+'.nii')
+    niiWriter.SetFileName(nii_fileName)
     niiWriter.SetQFormMatrix(orientation_mat)
     niiWriter.SetInputData(dicomImage)
     niiWriter.Write()
 
-class FileDlg(QWidget):
-
-    def __init__(self):
-        super().__init__()
-        self.title = 'PyQt5 file dialogs - pythonspot.com'
-        self.left = 10
-        self.top = 10
-        self.width = 640
-        self.height = 480
-        self.initUI()
-
-    def initUI(self):
-        self.setWindowTitle(self.title)
-        self.setGeometry(self.left, self.top, self.width, self.height)
-
-        # self.openFileNameDialog()
-        # self.openFileNamesDialog()
-
-        # self.show()
-
-    def openFileNameDialog(self):
-        options = QFileDialog.Options()
-        options |= QFileDialog.DontUseNativeDialog
-        fileName, _ = QFileDialog.getOpenFileName(self,"QFileDialog.getOpenFileName()", "","All Files (*);;Python Files (*.py)", options=options)
-        if fileName:
-            # print(fileName)
-            return fileName
+    if conversion['cache']:
+        _writeJSON(OrderedDict([
+            ('SeriesInstanceUID', conversion['SeriesInstanceUID']),
+            ('series', conversion['series']),
+            ('listing', conversion['listing']),
+            ('qform', conversion['qform']),
+            ('nii', _fileStamp(nii_fileName))
+            ]), conversion['cache'])
+
+    return nii_fileName
+
+def _dicom2niftiCacheHit(nii_fileName):
+    _dicom2nifti_cache['hits'] += 1
+    stats = dicom2niftiCacheStats()
+    message("Using cached NIFTI conversion: %s (cache hit rate %d/%d)" % (nii_fileName, stats['hits'], stats['hits'] + stats['misses']))
+    return nii_fileName
+
+def _fileStamp(fileName):
+    stat = os.stat(fileName)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _writeJSON(data, fileName):
+    """Writes the data as JSON, ignoring unwritable (e.g. read-only archive) directories."""
+    try:
+        with open(fileName, 'w') as f:
+            json.dump(data, f, indent=1)
+    except OSError as e:
+        message("WARNING: could not write %s" % fileName, str(e))
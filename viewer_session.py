@@ -0,0 +1,81 @@
+#####
+# viewer_session.py
+#
+# Launches the segmentation viewer (ITK-SNAP by default) on an image as a child
+# process and notifies the caller the moment it exits, without polling the
+# process table.
+#
+# The viewer command is configurable: pass it to ViewerSession or set the
+# OGO_VIEWER environment variable (e.g. OGO_VIEWER="/opt/itksnap/bin/itksnap -g"),
+# which also lets a test stub stand in for ITK-SNAP. The image file name is
+# appended as the last argument.
+#####
+
+import os
+import shlex
+import subprocess
+import sys
+import threading
+
+
+def defaultViewerCommand():
+    """Returns the command that opens an image in ITK-SNAP and only returns
+    once ITK-SNAP is closed, as a list of arguments.
+    """
+    if os.environ.get('OGO_VIEWER'):
+        return shlex.split(os.environ['OGO_VIEWER'], posix=(os.name != 'nt'))
+    if sys.platform == 'darwin':
+        # -W waits for the application to exit, -n starts a new instance so an
+        # ITK-SNAP that is already open does not hold up the session
+        return ['open', '-W', '-n', '-a', 'ITK-SNAP']
+    if sys.platform == 'win32':
+        return ['cmd', '/c', 'start', '/wait', '', 'ITK-SNAP.lnk']
+    return ['itksnap', '-g']
+
+
+class ViewerSession:
+    """One viewer process opened on an image.
+    The first argument is the image file name.
+    The second argument is the viewer command (defaults to defaultViewerCommand()).
+    The third argument is called with the exit code once the viewer exits. It
+    is called from a background thread, so GUI code must queue its work onto
+    the GUI thread.
+    """
+
+    def __init__(self, image, command=None, on_exit=None):
+        self.image = image
+        self.command = list(command) if command else defaultViewerCommand()
+        self.on_exit = on_exit
+        self.process = None
+        self.returncode = None
+        self._exited = threading.Event()
+
+    def start(self):
+        """Starts the viewer and a thread waiting for it to exit."""
+        if self.process is not None:
+            raise RuntimeError("ERROR: viewer session already started")
+        self.process = subprocess.Popen(self.command + [self.image])
+        threading.Thread(target=self._waitForExit, daemon=True).start()
+        return self
+
+    def running(self):
+        return self.process is not None and not self._exited.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the viewer exits (or the timeout in seconds passes).
+        Returns the exit code of the viewer, None if it is still running.
+        """
+        if self.process is None:
+            raise RuntimeError("ERROR: viewer session not started")
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def terminate(self):
+        if self.running():
+            self.process.terminate()
+
+    def _waitForExit(self):
+        self.returncode = self.process.wait()
+        self._exited.set()
+        if self.on_exit is not None:
+            self.on_exit(self.returncode)
@@ -0,0 +1,88 @@
+#####
+# vtk_numpy_views.py
+#
+# Views between vtkImageData and NumPy that share memory instead of copying.
+#
+# VTK stores image scalars with x varying fastest, then y, then z. The views
+# below index the same memory as [x, y, z] (a Fortran ordered array), so a
+# voxel has the same (i, j, k) in VTK and NumPy and no volume is copied or
+# reordered on the way in or out. Element-wise work can use flatView, which is
+# the scalars in memory order.
+#
+# NumPy views hold a reference to the VTK array, and VTK arrays wrapping NumPy
+# memory hold a reference to the NumPy array, so either side can be dropped
+# first.
+#####
+
+import numpy as np
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, get_vtk_array_type
+
+
+def allocateImage(reference, scalar_type=vtk.VTK_FLOAT, components=1):
+    """Creates an image on the grid (extent, origin, spacing) of a reference image.
+    The first argument is the reference vtkImageData.
+    The second argument is the VTK scalar type of the new image.
+    The third argument is the number of scalar components.
+    Returns the new vtkImageData (scalars are not initialized).
+    """
+    image = vtk.vtkImageData()
+    image.SetExtent(reference.GetExtent())
+    image.SetOrigin(reference.GetOrigin())
+    image.SetSpacing(reference.GetSpacing())
+    image.AllocateScalars(scalar_type, components)
+    return image
+
+def flatView(imageData):
+    """Returns the scalars of a vtkImageData as a 1D NumPy view in VTK memory
+    order (x fastest). Writing to the view writes to the image; call
+    imageModified afterwards so VTK pipelines see the change.
+    """
+    return vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(-1)
+
+def imageModified(imageData):
+    """Marks the scalars of an image as modified after writing through a view."""
+    imageData.GetPointData().GetScalars().Modified()
+    imageData.Modified()
+
+def imageView(imageData):
+    """Returns the scalars of a vtkImageData as a NumPy view indexed [x, y, z]
+    (or [x, y, z, component] for images with several components).
+    """
+    dimensions = imageData.GetDimensions()
+    components = imageData.GetNumberOfScalarComponents()
+    flat = flatView(imageData)
+    if components == 1:
+        return flat.reshape(dimensions, order='F')
+    return flat.reshape(dimensions[::-1] + (components,)).transpose(2, 1, 0, 3)
+
+def numpyToImage(array, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), extent=None):
+    """Wraps a NumPy array indexed [x, y, z] as vtkImageData.
+    The memory is shared when the array is Fortran contiguous (e.g. from
+    imageView, or the transpose of a C ordered [z, y, x] array), otherwise the
+    array is copied once into VTK order.
+    The first argument is the array.
+    The second and third arguments are the image spacing and origin.
+    The fourth argument is the image extent (defaults to starting at 0).
+    Returns the vtkImageData.
+    """
+    if array.ndim != 3:
+        raise ValueError("ERROR: expected a 3D [x, y, z] array, got shape %s" % (array.shape,))
+    if array.dtype == np.bool_:
+        array = array.view(np.uint8)
+
+    dimensions = array.shape
+    if extent is None:
+        extent = (0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1)
+    elif tuple(extent[1::2][i] - extent[0::2][i] + 1 for i in range(3)) != dimensions:
+        raise ValueError("ERROR: extent %s does not match array shape %s" % (tuple(extent), dimensions))
+
+    flat = array.ravel(order='F')
+    scalars = numpy_to_vtk(flat, deep=False, array_type=get_vtk_array_type(flat.dtype))
+
+    image = vtk.vtkImageData()
+    image.SetExtent(extent)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.GetPointData().SetScalars(scalars)
+    return image